@@ -0,0 +1,161 @@
+# -*- coding:utf-8 -*-
+#!/usr/bin/env python3
+#
+# Benchmark of the SQLiteRet scan modes on synthetic databases.
+#
+# A plain SQLite database is filled with messages in an FTS5IndexMessage_content table,
+# part of them is deleted, then each scan mode is timed and its output is compared with
+# the deleted messages, which are known.
+#
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import sqliteret
+
+
+#characters the messages are made of: mostly Chinese, with some ASCII, punctuation and emoji
+CJK = [chr(c) for c in range(0x4e00, 0x9fa6)]
+OTHERS = list('abcdefghijklmnopqrstuvwxyz0123456789 ,.!?') + list(u'，。！？') + [u'\U0001f600', u'\U0001f44d', u'❤']
+
+
+class CollectingWriter:
+    '''Keeps the recovered rows in memory instead of writing them, for comparison with the ground truth'''
+
+    checkpoint = None
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, profile, rows):
+        self.rows.extend(row[profile.key] for row in rows)
+
+    def add_corrupted(self, profile, rows):
+        self.rows.extend(row[profile.key] for row in rows if row[profile.key] is not None)
+
+    def page_done(self, pageno):
+        pass
+
+
+def random_message(rng, min_len, max_len, long_ratio, other_start=0):
+    '''Returns a random message starting with a Chinese character, or with another one for a share of them;
+    a share of them is long enough to overflow a page'''
+    length = rng.randint(min_len, max_len)
+    if rng.random() < long_ratio: length *= 50
+    chars = [rng.choice(OTHERS) if other_start and rng.random() < other_start else rng.choice(CJK)]
+    for i in range(length-1):
+        chars.append(rng.choice(OTHERS) if rng.random() < 0.15 else rng.choice(CJK))
+    return ''.join(chars)
+
+
+def build_database(path, size, pagesize, delete_ratio, seed, min_len, max_len, long_ratio, other_start=0):
+    '''Creates a database of about size bytes, deletes a share of its messages; returns (deleted messages, live messages)'''
+
+    rng = random.Random(seed)
+    if os.path.exists(path): os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA page_size = %d' % pagesize)
+    #deleted records must be left in place, as on the handsets
+    conn.execute('PRAGMA secure_delete = OFF')
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('CREATE TABLE FTS5IndexMessage_content (id INTEGER PRIMARY KEY, c0 TEXT)')
+
+    #insert in batches until the file reaches the requested size; the row number keeps the messages unique
+    messages = []
+    while os.path.getsize(path) < size:
+        batch = []
+        for i in range(1000):
+            batch.append(random_message(rng, min_len, max_len, long_ratio, other_start) + chinese_digits(len(messages)+len(batch)))
+        conn.executemany('INSERT INTO FTS5IndexMessage_content (c0) VALUES (?)', ((m,) for m in batch))
+        conn.commit()
+        messages.extend(batch)
+
+    #delete a random share of the rows, in random order
+    ids = rng.sample(range(1, len(messages)+1), int(len(messages)*delete_ratio))
+    for i in range(0, len(ids), 1000):
+        conn.executemany('DELETE FROM FTS5IndexMessage_content WHERE id = ?', ((rowid,) for rowid in ids[i:i+1000]))
+        conn.commit()
+    conn.close()
+
+    deleted = set(messages[rowid-1] for rowid in ids)
+    return deleted, set(messages) - deleted
+
+
+def chinese_digits(number):
+    '''Writes a number with Chinese digits'''
+    return ''.join(u'零一二三四五六七八九'[int(d)] for d in str(number))
+
+
+def run_mode(path, mode, jobs, freespace, scripts=sqliteret.DEFAULT_SCRIPTS, exhaustive=False, corrupted=False):
+    '''Runs one scan mode on the database; returns (seconds, recovered keys)'''
+
+    with contextlib.redirect_stdout(sqliteret.NullWriter()):
+        scanner = sqliteret.DBScanner(path, False, corrupted, False, False, False, False, jobs=jobs, freespace=freespace, scripts=scripts, exhaustive=exhaustive)
+        scanner.writer = CollectingWriter()
+        start = time.time()
+        if mode == 'all': scanner.all_table_scan()
+        elif mode == 'root': scanner.from_root()
+        else: scanner.unknown_root()
+        elapsed = time.time() - start
+    return elapsed, scanner.writer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the SQLiteRet scan modes on synthetic databases with known deleted messages.')
+    parser.add_argument('--size', type=float, default=8, metavar='MB', help='size of the database in MB (default: 8)')
+    parser.add_argument('--page-size', type=int, default=1024, help='database page size (default: 1024)')
+    parser.add_argument('--delete', type=float, default=0.3, metavar='RATIO', help='share of the messages to delete (default: 0.3)')
+    parser.add_argument('--min-len', type=int, default=2, help='minimum message length in characters (default: 2)')
+    parser.add_argument('--max-len', type=int, default=60, help='maximum message length in characters (default: 60)')
+    parser.add_argument('--long', type=float, default=0.01, metavar='RATIO', help='share of messages 50 times longer (default: 0.01)')
+    parser.add_argument('--other-start', type=float, default=0, metavar='RATIO', help='share of messages starting with an ASCII character, punctuation or an emoji (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--modes', default='all,root,unknown', help='comma-separated scan modes among all, root, unknown (default: all of them)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='worker processes for the all mode')
+    parser.add_argument('--freespace', action='store_true', help='scan only the free space of the pages')
+    parser.add_argument('--exhaustive', action='store_true', help='probe every byte inside the rows already found')
+    parser.add_argument('-c', '--corrupted', action='store_true', help='also recover the rows with corrupted headers')
+    parser.add_argument('--scripts', type=sqliteret.script_classes, default=sqliteret.DEFAULT_SCRIPTS, metavar='LIST', help='script classes of the messages, as in sqliteret.py (default: cjk)')
+    parser.add_argument('--db', metavar='FILE', help='path of the database to build (default: a temporary file, removed at the end)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    start = time.time()
+    deleted, live = build_database(path, int(args.size*1024*1024), args.page_size, args.delete, args.seed, args.min_len, args.max_len, args.long, args.other_start)
+    filesize = os.path.getsize(path)
+    pages = filesize // args.page_size
+    if not args.json:
+        print('Database: %s, %.1f MB, %d pages of %d bytes, %d live and %d deleted messages, built in %.1f s'
+              % (path, filesize/1048576.0, pages, args.page_size, len(live), len(deleted), time.time()-start))
+        print('%-8s %9s %10s %8s %10s %8s %10s' % ('mode', 'seconds', 'pages/s', 'MB/s', 'recovered', 'recall', 'precision'))
+
+    try:
+        for mode in args.modes.split(','):
+            elapsed, rows = run_mode(path, mode, args.jobs, args.freespace, args.scripts, args.exhaustive, args.corrupted)
+
+            #the rows which are not live are the ones the scan reports as deleted
+            claimed = set(rows) - live
+            hits = len(claimed & deleted)
+            result = {'mode': mode, 'seconds': elapsed, 'pages_per_s': pages/elapsed, 'mb_per_s': filesize/1048576.0/elapsed,
+                      'recovered': len(claimed), 'recall': hits/float(len(deleted) or 1), 'precision': hits/float(len(claimed) or 1)}
+
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('%-8s %9.2f %10.0f %8.2f %10d %8.3f %10.3f' % (mode, elapsed, result['pages_per_s'], result['mb_per_s'],
+                                                                   result['recovered'], result['recall'], result['precision']))
+    finally:
+        if not args.db:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    main()
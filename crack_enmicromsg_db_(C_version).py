@@ -1,68 +1,120 @@
 # 1. install openssl dev package:
 #    $ sudo apt-get install libssl-dev
 
-# 2. compile password_cracker.c:
-#    $ gcc password_cracker.c  -l crypto -o password_cracker.o
+# 2. compile password_cracker.c into libpassword_cracker.so (and the command password_cracker.o):
+#    $ make
 
-# 3. modify following parameters in this file and then run.
+# 3. modify following parameters in this file (or pass them as options, see --help) and then run.
 
 db_file_name = 'EnMicroMsg.db'
 pass_file_name = 'pass.txt'
-process_no = 4
+process_no = None      # None: one per core
 
 pass_start = 0x0000000
 pass_end =   0xfffffff
 pass_truck_size = 4000
 
+# IMEIs and uins of the handset: the keys derived from them are tried before the
+# keyspace search (the missing files are skipped)
+imei_file = 'imei.txt'
+uin_file = 'uin.txt'
+prefs_path = 'shared_prefs'
+
+# SQLCipher settings of the database (WeChat's); with pycryptodome installed, the derived keys
+# are probed with every usual setting first
+cipher_page_size = 1024
+kdf_iter = 4000
+reserve = 16           # 16: the IV only, no HMAC
+kdf_algorithm = 'sha1'
+
 
 # ====================================
 
 
-import threading
 import time, os
-import Queue, subprocess
-
-pass_seg = Queue.Queue()
-bin_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'password_cracker.o')
-
-class workerThread(threading.Thread):
-    def __init__(self, threadID, name, pass_seg_):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
-        self.name = name
-        self.pass_seg = pass_seg_
-
-    def run(self):
-        print('Thread %d started...' % (self.threadID))
-        while not pass_seg.empty():
-            sn_start, sn_end = self.pass_seg.get()
-            if sn_start is None:
-                break
-            if os.path.exists(pass_file_name):
-                break
-            print(subprocess.check_output([bin_path, db_file_name,
-                                           pass_file_name,
-                                          hex(sn_start), hex(sn_end)]))
-
+import threading
+from argparse import ArgumentParser
+
+from key_candidates import load_candidates
+from keyspace import KeyspaceScheduler, run_workers, cpu_count, CHUNK_SECONDS
+from password_cracker import NativeCracker, LIB_PATH
+import sqlcipher_key
+
+# set as soon as a worker finds the key; the native search loops poll the stop flag of the cracker
+found = threading.Event()
+
+
+def crack(sn_start, sn_end):
+    key, tried = cracker.search(sn_start, sn_end)
+    if key is not None:
+        print('Key found: %07x' % key)
+        with open(pass_file_name, 'a') as f:
+            f.write('%07x\n' % key)
+    if cracker.stopped():
+        found.set()
+    return tried
+
+
+parser = ArgumentParser(description='Searches the key of an EnMicroMsg.db with libpassword_cracker.so.')
+parser.add_argument('-j', '--workers', type=int, default=process_no or cpu_count(),
+                    help='number of worker threads searching at once (default: number of cores)')
+parser.add_argument('--chunk-seconds', type=float, default=CHUNK_SECONDS,
+                    help='target duration of a range of keys, from which its size is tuned (default: %(default)s)')
+parser.add_argument('--start', type=lambda x: int(x, 16), default=pass_start, help='first key to try, in hex')
+parser.add_argument('--end', type=lambda x: int(x, 16), default=pass_end, help='last key to try, in hex')
+parser.add_argument('--status-every', type=float, default=10, metavar='SECONDS',
+                    help='interval of the JSON status lines: keys tried, keys/s, percent, ETA, per worker counters (default: 10, 0 for the last one only)')
+parser.add_argument('--status-file', metavar='FILE', help='file the JSON status lines are appended to (default: standard output)')
+args = parser.parse_args()
 
 if os.path.exists(pass_file_name):
     print('Pls delete %s and then try again.' % (pass_file_name))
     exit(0)
 
-if not os.path.exists(bin_path):
+if not os.path.exists(LIB_PATH):
     print('Code has NOT been complied. Pls complie it first.')
     exit(0)
 
-while pass_start<= pass_end:
-    pass_seg.put((pass_start,min(pass_start+pass_truck_size-1, pass_end)))
-    pass_start += pass_truck_size
-
-thread_pool =[]
-for i in range(process_no):
-    thread_pool.append( workerThread(i, 'Worker %d' % i, pass_seg))
+# derived keys first
+derived_keys = load_candidates(imei_file, uin_file, prefs_path)
+if derived_keys:
+    print('Trying %d keys derived from the device identifiers...' % len(derived_keys))
+if derived_keys and sqlcipher_key.AES is not None:
+    settings = sqlcipher_key.probe(db_file_name, derived_keys)
+    if settings:
+        print('Key found among the derived keys: %(key)s (settings: %(version)s, page size %(page_size)d, '
+              'kdf_iter %(kdf_iter)d, PBKDF2-HMAC-%(kdf_algorithm)s, %(reserve)d reserved bytes)' % settings)
+        with open(pass_file_name, 'a') as f:
+            f.write(settings['key'] + '\n')
+        exit(0)
+    derived_keys = []
+
+# the settings must at least fit the file, or the whole keyspace would be searched in vain
+problems = sqlcipher_key.structure_check(db_file_name, cipher_page_size)
+if problems:
+    for problem in problems:
+        print(problem)
+    exit(0)
 
-[x.start() for x  in thread_pool]
+# page 1 of the database is read once, and shared by the workers
+try:
+    cracker = NativeCracker(db_file_name, page_size=cipher_page_size, kdf_iter=kdf_iter, reserve=reserve, kdf_algorithm=kdf_algorithm)
+except IOError as e:
+    print(e)
+    exit(0)
 
-[x.join() for x in thread_pool]
+# without pycryptodome, each derived key is tried with the settings above, as a range of one key
+for key in derived_keys:
+    crack(int(key, 16), int(key, 16))
+    if found.is_set():
+        print('Key found among the derived keys.')
+        cracker.close()
+        exit(0)
+
+# the first ranges have pass_truck_size keys, the next ones are sized from the measured throughput
+scheduler = KeyspaceScheduler(args.start, args.end, args.workers, args.chunk_seconds, first_chunk=pass_truck_size)
+status = open(args.status_file, 'a') if args.status_file else None
+run_workers(scheduler, crack, found, args.status_every, status)
+cracker.close()
 
 print("Exiting Main Thread")
\ No newline at end of file
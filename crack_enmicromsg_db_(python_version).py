@@ -9,90 +9,148 @@ from pysqlcipher import dbapi2 as sqlite
 
 from hashlib import md5
 
+# Candidate keys are checked by decrypting the first block of page 1 (needs pycryptodome:
+# pip install pycryptodome); SQLCipher is only opened for the key which passes the check.
+from sqlcipher_key import KeyVerifier, probe, structure_check
+from key_candidates import load_candidates
+from keyspace import KeyspaceScheduler, run_workers, cpu_count, key_of, KEYSPACE_END, CHUNK_SECONDS
+
 
-TOTAL_KEY_LENGTH = 7
-PROCESS_KEY_LENGTH = 3
-process_no = 12
 db = 'EnMicroMsg.db'
 output = 'output_db.db'
 
-def worker(id, prefix):
-    import itertools, time
-    print ('-------------id: %d  ===== prefix: %s' % (id, prefix))
-    if os.path.exists(output):
-        return  'Alread Done.'
+# IMEIs and uins of the handset, tried before the keyspace search (the missing files are skipped)
+imei_file = 'imei.txt'
+uin_file = 'uin.txt'
+prefs_path = 'shared_prefs'
+
+# SQLCipher settings of the database (WeChat's); when there are derived keys, they are probed
+# with every usual setting, and the settings a key opens the database with replace these
+cipher_page_size = 1024
+kdf_iter = 4000
+use_hmac = False
+reserve = 16
+kdf_algorithm = 'sha1'
+
+def try_key(key):
+    conn = None
+    try:
+        conn = sqlite.connect(db)
+        c = conn.cursor()
+
+        c.execute("PRAGMA key = '" + key + "';")
+        c.execute("PRAGMA cipher_use_hmac = %s;" % ('ON' if use_hmac else 'OFF'))
+        c.execute("PRAGMA cipher_page_size = %d;" % cipher_page_size)
+        c.execute("PRAGMA kdf_iter = %d;" % kdf_iter)
+        if kdf_algorithm != 'sha1':
+            # SQLCipher 4 settings; SQLCipher 3 ignores these pragmas
+            c.execute("PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_%s;" % kdf_algorithm.upper())
+            c.execute("PRAGMA cipher_hmac_algorithm = HMAC_%s;" % kdf_algorithm.upper())
+        c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+
+        c.execute("ATTACH DATABASE '" + output + "' AS db KEY '';")
+        c.execute("SELECT sqlcipher_export('db');")
+        c.execute("DETACH DATABASE db;")
+        print "Decrypt and dump database to {} ... ".format(output)
+        print key
+        print('OK!!!!!!!!!')
+        with open('CRACKED_PASS.txt', 'a') as f:
+            f.write(key)
+            f.write('\n')
+        return True
+    except Exception as e:
+        # print(str(e))
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
+
+def derived_key():
+    # keys derived from the IMEIs and uins, probed with the usual settings; returns the one which opens the database
+    global cipher_page_size, kdf_iter, use_hmac, reserve, kdf_algorithm
+    keys = load_candidates(imei_file, uin_file, prefs_path)
+    if not keys:
+        return None
+    print('Trying %d keys derived from the device identifiers...' % len(keys))
+    settings = probe(db, keys)
+    if settings is None:
+        print('None of the derived keys opens %s, searching the keyspace.' % db)
+        return None
+    print('Settings: %(version)s, page size %(page_size)d, kdf_iter %(kdf_iter)d, PBKDF2-HMAC-%(kdf_algorithm)s, HMAC %(hmac)s' % settings)
+    cipher_page_size, kdf_iter, use_hmac, reserve = settings['page_size'], settings['kdf_iter'], settings['hmac'], settings['reserve']
+    kdf_algorithm = settings['kdf_algorithm']
+    if try_key(settings['key']):
+        return settings['key']
+    # the key is known all the same: it is reported rather than searched for in the keyspace
+    print('Key found among the derived keys: %s, but pysqlcipher cannot open %s with these settings.' % (settings['key'], db))
+    with open('CRACKED_PASS.txt', 'a') as f:
+        f.write(settings['key'])
+        f.write('\n')
+    return settings['key']
+
+# set by the worker which finds the key; the other workers poll it for every key and stop
+found = None
+verifier = None
 
-    a = time.time()
-    str_list = '0123456789abcdef'
-    key_length = TOTAL_KEY_LENGTH - PROCESS_KEY_LENGTH
+def init_worker(event):
+    global found, verifier
+    found = event
+    verifier = KeyVerifier(db, cipher_page_size, kdf_iter, reserve, kdf_algorithm)
+
+def search_range(start, end):
+    # searches the keys start to end; returns the number of keys tried
     count = 0
-    for i in itertools.product(str_list, repeat=key_length):
+    for n in range(start, end + 1):
+        if found.is_set():
+            break
         count += 1
-        key = prefix + ''.join(i)
-        try:
-            conn = sqlite.connect(db)
-            c = conn.cursor()
-
-            c.execute("PRAGMA key = '" + key + "';")
-            c.execute("PRAGMA cipher_use_hmac = OFF;")
-            c.execute("PRAGMA cipher_page_size = 1024;")
-            c.execute("PRAGMA kdf_iter = 4000;")
-            c.execute("SELECT name FROM sqlite_master WHERE type='table'")
-
-            c.execute("ATTACH DATABASE '" + output + "' AS db KEY '';")
-            c.execute("SELECT sqlcipher_export('db');")
-            c.execute("DETACH DATABASE db;")
-            print "Decrypt and dump database to {} ... ".format(output)
-            print key
-            print('OK!!!!!!!!!')
-            with open('CRACKED_PASS.txt', 'a') as f:
-                f.write(key)
-                f.write('\n')
+        key = key_of(n)
+        if verifier.check(key) and try_key(key):
+            found.set()
             break
-        except Exception as e:
-            # print(str(e))
-            pass
-        finally:
-            conn.close()
-
-        # if count > count_limit:
-        #     break
-        if count % 100000 == 0:
-            p = 1.0 * count / 16 ** key_length
-            b = time.time() - a
-            rt = b / (p + 0.0000001) * (1 - p)
-            print('%d: %f %%, time: %f s, end time: %f s' % (id, p * 100,
-                                                             b,
-                                                             rt)
-                  )
-            print(key)
-
-    b = time.time() - a
-    print('%d: Total time: %f s, per loop: %f s' % (id, b, b / count))
-    return '%d Done' % (id)
+    return count
 
 DEFAULT_OUTPUT_DB_NAME = 'decrypted.db'
 
 if __name__ == '__main__':
 
-    str_list = '0123456789abcdef'
-    key_length1 = PROCESS_KEY_LENGTH
-
-    # Multi-process
-    record = []
-    result = []
-    pool = multiprocessing.Pool(processes=process_no)
-    id_a = 0
-    for i in itertools.product(str_list, repeat=key_length1):
-        prefix = ''.join(i)
-        result.append(pool.apply_async(worker, (id_a, prefix)))
-        id_a += 1
-        if os.path.exists(output):
-            print  'Alread Done.'
-            break
+    parser = ArgumentParser(description='Searches the key of %s and dumps the decrypted database to %s.' % (db, output))
+    parser.add_argument('-j', '--workers', type=int, default=cpu_count(),
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--chunk-seconds', type=float, default=CHUNK_SECONDS,
+                        help='target duration of a range of keys, from which its size is tuned (default: %(default)s)')
+    parser.add_argument('--start', type=lambda x: int(x, 16), default=0, help='first key to try, in hex (default: 0000000)')
+    parser.add_argument('--end', type=lambda x: int(x, 16), default=KEYSPACE_END, help='last key to try, in hex (default: fffffff)')
+    parser.add_argument('--status-every', type=float, default=10, metavar='SECONDS',
+                        help='interval of the JSON status lines: keys tried, keys/s, percent, ETA, per worker counters (default: 10, 0 for the last one only)')
+    parser.add_argument('--status-file', metavar='FILE', help='file the JSON status lines are appended to (default: standard output)')
+    args = parser.parse_args()
+
+    if os.path.exists(output):
+        print  'Alread Done.'
+        sys.exit(0)
+    if derived_key() is not None:
+        sys.exit(0)
+    # the settings must at least fit the file, or the whole keyspace would be searched in vain
+    problems = structure_check(db, cipher_page_size)
+    if problems:
+        for problem in problems:
+            print(problem)
+        sys.exit(0)
+
+    # Multi-process: one dispatching thread per process, each taking the next range of keys when its process is done
+    found_event = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes=args.workers, initializer=init_worker, initargs=(found_event,))
+    scheduler = KeyspaceScheduler(args.start, args.end, args.workers, args.chunk_seconds)
+    print('Searching keys %s to %s with %d workers...' % (key_of(args.start), key_of(args.end), args.workers))
+    status = open(args.status_file, 'a') if args.status_file else None
+    run_workers(scheduler, lambda start, end: pool.apply(search_range, (start, end)), found_event,
+                args.status_every, status)
 
     pool.close()
     pool.join()
-    for res in result:
-        print res.get()
+    p, b, rt = scheduler.progress()
+    print('Total time: %f s, %f %% of the keys searched' % (b, p * 100))
+    if not found_event.is_set():
+        print('The key has not been found.')
     print "Sub-process(es) done."
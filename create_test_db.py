@@ -3,17 +3,28 @@ from pysqlcipher import dbapi2 as sqlite
 
 from hashlib import md5
 
-db = 'EnMicroMsg.db'
+# Creates an encrypted test database. The defaults are WeChat's settings; other page sizes,
+# kdf_iter or HMAC give databases to check the probing of the settings with.
 
-key = '00001ef'
+parser = ArgumentParser(description='Creates an encrypted SQLCipher test database.')
+parser.add_argument('--db', default='EnMicroMsg.db', help='database to create (default: %(default)s)')
+parser.add_argument('--key', default='00001ef', help='key of the database (default: %(default)s)')
+parser.add_argument('--page-size', type=int, default=1024, help='cipher_page_size (default: %(default)s)')
+parser.add_argument('--kdf-iter', type=int, default=4000, help='kdf_iter (default: %(default)s)')
+parser.add_argument('--hmac', action='store_true', help='turn cipher_use_hmac on')
+args = parser.parse_args()
+
+db = args.db
+
+key = args.key
 
 conn = sqlite.connect(db)
 c = conn.cursor()
 c.execute("PRAGMA key = '" + key + "';")
-c.execute("PRAGMA cipher_use_hmac = OFF;")
-c.execute("PRAGMA cipher_page_size = 1024;")
-c.execute("PRAGMA kdf_iter = 4000;")
+c.execute("PRAGMA cipher_use_hmac = %s;" % ('ON' if args.hmac else 'OFF'))
+c.execute("PRAGMA cipher_page_size = %d;" % args.page_size)
+c.execute("PRAGMA kdf_iter = %d;" % args.kdf_iter)
 
 c.execute("create table test_table (test_col text primary key)")
 
-c.close()
+c.close()
\ No newline at end of file
@@ -0,0 +1,106 @@
+# Candidate keys of EnMicroMsg.db derived from known device identifiers.
+#
+# The key of EnMicroMsg.db is the first 7 hex digits of md5(IMEI + uin). When the IMEI and
+# the uin of the handset are known, the key is found in a few tries instead of a search of
+# the whole keyspace. They are taken from:
+#   - lists of IMEIs and uins, one per line (lines starting with # are ignored)
+#   - the shared_prefs directory of the WeChat data (or single XML files of it), where
+#     system_config_prefs.xml holds default_uin and auth_info_key_prefs.xml holds _auth_uin
+#   - the IMEI "1234567890ABCDEF", used by WeChat when it cannot read the IMEI
+# Works with both Python 2 and Python 3.
+
+import os
+import re
+import xml.etree.ElementTree as ET
+from hashlib import md5
+
+
+DEFAULT_IMEI = '1234567890ABCDEF'
+KEY_LENGTH = 7
+
+# entries of shared_prefs holding the uin, and the IMEI on some versions
+UIN_NAMES = ('default_uin', '_auth_uin', 'last_login_uin')
+IMEI_NAMES = ('imei', 'device_id', 'deviceid')
+
+
+def read_list(path):
+    '''Returns the values of a file with one value per line'''
+    values = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                values.append(line)
+    return values
+
+
+def read_shared_prefs(path):
+    '''Returns (IMEIs, uins) found in a shared_prefs directory or a single XML file of it'''
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.xml')]
+    else:
+        files = [path]
+
+    imeis, uins = [], []
+    for name in files:
+        try:
+            root = ET.parse(name).getroot()
+        except (ET.ParseError, IOError, OSError):
+            continue
+        # <int name="default_uin" value="-123456" /> or <string name="...">value</string>
+        for entry in root:
+            key = (entry.get('name') or '').lower()
+            value = entry.get('value', entry.text)
+            if value is None:
+                continue
+            value = value.strip()
+            if key in UIN_NAMES and re.match(r'^-?\d+$', value):
+                uins.append(value)
+            elif key in IMEI_NAMES and value:
+                imeis.append(value)
+    return imeis, uins
+
+
+def uin_forms(uin):
+    '''The uin as stored (a signed 32-bit integer) and its unsigned form, both seen in key derivations'''
+    forms = [str(uin)]
+    try:
+        value = int(uin)
+    except ValueError:
+        return forms
+    if value < 0:
+        forms.append(str(value & 0xffffffff))
+    return forms
+
+
+def derive_key(imei, uin):
+    '''Key of EnMicroMsg.db for an IMEI and a uin'''
+    return md5((imei + uin).encode('utf-8')).hexdigest()[:KEY_LENGTH]
+
+
+def candidate_keys(imeis=(), uins=()):
+    '''Returns the keys of every IMEI and uin pair, without duplicates, in the order of the IMEIs given then the default one'''
+    keys = []
+    seen = set()
+    for imei in list(imeis) + [DEFAULT_IMEI]:
+        for uin in uins:
+            for form in uin_forms(uin):
+                key = derive_key(imei, form)
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+    return keys
+
+
+def load_candidates(imei_file=None, uin_file=None, prefs=None):
+    '''Collects the IMEIs and uins of the files which exist among the given ones; returns the candidate keys'''
+    imeis, uins = [], []
+    if imei_file and os.path.exists(imei_file):
+        imeis.extend(read_list(imei_file))
+    if uin_file and os.path.exists(uin_file):
+        uins.extend(read_list(uin_file))
+    if prefs and os.path.exists(prefs):
+        prefs_imeis, prefs_uins = read_shared_prefs(prefs)
+        imeis.extend(prefs_imeis)
+        uins.extend(prefs_uins)
+    return candidate_keys(imeis, uins)
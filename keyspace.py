@@ -0,0 +1,161 @@
+# Scheduling of the keyspace search over the workers of the crack scripts.
+#
+# The keyspace is handed out in ranges of keys, one at a time, to the worker asking for
+# work, so a slow worker takes fewer ranges and none stays idle while others have work.
+# The size of a range is set from the measured throughput so that one range takes about
+# CHUNK_SECONDS; towards the end of the search the ranges get smaller so that the workers
+# finish together.
+# The counters of the workers are collected by SearchMetrics, which writes them as JSON
+# status lines.
+# Works with both Python 2 and Python 3.
+
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+
+KEY_LENGTH = 7
+KEYSPACE_END = 16 ** KEY_LENGTH - 1
+
+CHUNK_SECONDS = 2.0
+FIRST_CHUNK = 256
+MIN_CHUNK = 16
+
+
+def cpu_count():
+    '''Number of cores, 1 if unknown'''
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def key_of(number):
+    '''Key of a position of the keyspace: 7 lowercase hex digits'''
+    return '%07x' % number
+
+
+class SearchMetrics(object):
+    '''Counters of the keys tried by each worker, written as JSON status lines'''
+
+    def __init__(self, total, workers):
+        self.total = total
+        self.started = time.time()
+        self.keys = [0] * workers
+        self.seconds = [0.0] * workers
+        self.ranges = [0] * workers
+        self.lock = threading.Lock()
+
+    def add(self, worker, keys, seconds):
+        with self.lock:
+            self.keys[worker] += keys
+            self.seconds[worker] += seconds
+            self.ranges[worker] += 1
+
+    def status(self, found=False):
+        '''Returns the keys tried, keys/s, percent done, ETA and the counters of each worker'''
+        with self.lock:
+            keys = sum(self.keys)
+            workers = [{'worker': i, 'keys': self.keys[i], 'ranges': self.ranges[i],
+                        'keys_per_s': round(self.keys[i] / self.seconds[i], 1) if self.seconds[i] else 0.0}
+                       for i in range(len(self.keys))]
+        elapsed = time.time() - self.started
+        rate = keys / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - keys
+        return {'time': round(time.time(), 3), 'elapsed': round(elapsed, 3), 'keys': keys, 'total': self.total,
+                'keys_per_s': round(rate, 1), 'percent': round(100.0 * keys / self.total, 4),
+                'eta': round(remaining / rate, 1) if rate else None, 'found': found, 'workers': workers}
+
+    def emit(self, out=None, found=False):
+        '''Writes the status as one JSON line'''
+        out = out or sys.stdout
+        out.write(json.dumps(self.status(found), sort_keys=True) + '\n')
+        out.flush()
+
+
+class KeyspaceScheduler(object):
+    '''Hands out the ranges [start, end] of the keyspace, sized from the measured throughput'''
+
+    def __init__(self, start=0, end=KEYSPACE_END, workers=None, chunk_seconds=CHUNK_SECONDS, first_chunk=FIRST_CHUNK):
+        self.start = start
+        self.end = end
+        self.total = end - start + 1
+        self.workers = max(1, workers or cpu_count())
+        self.chunk_seconds = chunk_seconds
+        self.first_chunk = first_chunk
+
+        self.next = start
+        self.searched = 0
+        # keys per second of one worker, smoothed over the ranges done
+        self.rate = None
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.metrics = SearchMetrics(self.total, self.workers)
+
+    def chunk_size(self):
+        if self.rate is None:
+            size = self.first_chunk
+        else:
+            size = int(self.rate * self.chunk_seconds)
+        # no more than half a share of what is left, so that the last ranges are spread over the workers
+        remaining = self.end - self.next + 1
+        size = min(size, remaining // (2 * self.workers))
+        return max(MIN_CHUNK, size)
+
+    def next_chunk(self):
+        '''Returns the next range (start, end) to search, None once the keyspace is exhausted'''
+        with self.lock:
+            if self.next > self.end:
+                return None
+            start = self.next
+            end = min(self.end, start + self.chunk_size() - 1)
+            self.next = end + 1
+            return start, end
+
+    def done(self, keys, seconds, worker=0):
+        '''Records a range of keys searched by a worker in the given time'''
+        self.metrics.add(worker, keys, seconds)
+        with self.lock:
+            self.searched += keys
+            if seconds > 0 and keys > 0:
+                rate = keys / float(seconds)
+                self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+
+    def progress(self):
+        '''Returns (fraction searched, elapsed seconds, estimated remaining seconds)'''
+        with self.lock:
+            p = 1.0 * self.searched / self.total
+        elapsed = time.time() - self.started
+        return p, elapsed, elapsed / (p + 0.0000001) * (1 - p)
+
+
+def run_workers(scheduler, search, found, report_every=60, out=None):
+    '''Runs one thread per worker, each searching the ranges of the scheduler with search(start, end)
+    until the keyspace is exhausted or found is set; search returns the number of keys it tried.
+    A JSON status line is written to out every report_every seconds and at the end'''
+
+    def loop(worker):
+        while not found.is_set():
+            chunk = scheduler.next_chunk()
+            if chunk is None:
+                break
+            a = time.time()
+            keys = search(*chunk)
+            scheduler.done(keys, time.time() - a, worker)
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(scheduler.workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # join with a timeout, to report the progress and to stay interruptible
+    last = time.time()
+    for t in threads:
+        while t.is_alive():
+            t.join(0.1)
+            if report_every and time.time() - last >= report_every:
+                last = time.time()
+                scheduler.metrics.emit(out, found.is_set())
+    scheduler.metrics.emit(out, found.is_set())
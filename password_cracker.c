@@ -0,0 +1,192 @@
+/*
+ * Key search of EnMicroMsg.db, a SQLCipher database with WeChat's settings:
+ * cipher_use_hmac = OFF, cipher_page_size = 1024, kdf_iter = 4000.
+ *
+ * A candidate key is checked without SQLCipher: the first 16 bytes of the file are the salt
+ * of PBKDF2-HMAC-SHA1, and the first encrypted block of page 1 decrypts, with the IV stored
+ * in the reserved bytes at the end of the page, to bytes 16 to 31 of the SQLite header, whose
+ * values are known. Page 1 is read once, then each key costs one PBKDF2 and one AES block.
+ *
+ * Built both as a command (see crack_enmicromsg_db_(C_version).py) and as a library loaded
+ * with ctypes; see the Makefile:
+ *    $ make
+ *
+ * Command:
+ *    $ ./password_cracker.o EnMicroMsg.db pass.txt 0x0000000 0xfffffff
+ * searches the keys 0000000 to fffffff and appends the key found to pass.txt.
+ *
+ * Library:
+ *    pc_open(path, page_size, kdf_iter, reserve, kdf_algorithm)
+ *                                                 reads page 1, returns a context (NULL on error);
+ *                                                 0 or NULL select WeChat's settings
+ *    pc_search(ctx, start, end, stop, tried)      searches the keys start to end, returns the
+ *                                                 key found or -1; stops when *stop is set
+ *    pc_close(ctx)
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include <openssl/evp.h>
+
+#define SALT_SIZE 16
+#define BLOCK_SIZE 16
+#define KEY_SIZE 32
+#define KEY_LENGTH 7
+
+#define PAGE_SIZE 1024
+#define KDF_ITER 4000
+#define RESERVE 16
+#define KDF_ALGORITHM "sha1"
+
+typedef struct {
+    int page_size;
+    int kdf_iter;
+    int reserve;
+    const EVP_MD *kdf_md;
+    unsigned char salt[SALT_SIZE];
+    unsigned char first_block[BLOCK_SIZE];
+    unsigned char iv[BLOCK_SIZE];
+} pc_ctx;
+
+pc_ctx *pc_open(const char *path, int page_size, int kdf_iter, int reserve, const char *kdf_algorithm)
+{
+    pc_ctx *ctx;
+    unsigned char *page;
+    const EVP_MD *kdf_md;
+    FILE *f;
+    size_t n;
+
+    if (page_size <= 0) page_size = PAGE_SIZE;
+    if (kdf_iter <= 0) kdf_iter = KDF_ITER;
+    if (reserve <= 0) reserve = RESERVE;
+    if (reserve < BLOCK_SIZE || reserve >= page_size - SALT_SIZE - BLOCK_SIZE)
+        return NULL;
+    /* the hash of PBKDF2-HMAC: sha1 (WeChat), sha256, sha512 (SQLCipher 4) */
+    kdf_md = EVP_get_digestbyname(kdf_algorithm && *kdf_algorithm ? kdf_algorithm : KDF_ALGORITHM);
+    if (!kdf_md)
+        return NULL;
+
+    f = fopen(path, "rb");
+    if (!f)
+        return NULL;
+    page = malloc(page_size);
+    n = page ? fread(page, 1, page_size, f) : 0;
+    fclose(f);
+    if (n != (size_t)page_size) {
+        free(page);
+        return NULL;
+    }
+
+    ctx = malloc(sizeof(pc_ctx));
+    if (ctx) {
+        ctx->page_size = page_size;
+        ctx->kdf_iter = kdf_iter;
+        ctx->reserve = reserve;
+        ctx->kdf_md = kdf_md;
+        memcpy(ctx->salt, page, SALT_SIZE);
+        memcpy(ctx->first_block, page + SALT_SIZE, BLOCK_SIZE);
+        memcpy(ctx->iv, page + page_size - reserve, BLOCK_SIZE);
+    }
+    free(page);
+    return ctx;
+}
+
+void pc_close(pc_ctx *ctx)
+{
+    free(ctx);
+}
+
+/* bytes 16 to 23 of the SQLite header: page size, format versions, reserved bytes, payload fractions */
+static int header_ok(const pc_ctx *ctx, const unsigned char *plain)
+{
+    int size = (plain[0] << 8) | plain[1];
+
+    if (size == 1)
+        size = 65536;
+    /* the reserved bytes hold at least the IV; databases created with HMAC before it was turned off declare more */
+    return size == ctx->page_size && (plain[2] == 1 || plain[2] == 2) && (plain[3] == 1 || plain[3] == 2)
+           && plain[4] >= ctx->reserve && plain[5] == 64 && plain[6] == 32 && plain[7] == 32;
+}
+
+static int check_key(const pc_ctx *ctx, EVP_CIPHER_CTX *cipher, const char *key)
+{
+    unsigned char derived[KEY_SIZE], plain[BLOCK_SIZE];
+    int len, i;
+
+    if (!PKCS5_PBKDF2_HMAC(key, KEY_LENGTH, ctx->salt, SALT_SIZE, ctx->kdf_iter, ctx->kdf_md, KEY_SIZE, derived))
+        return 0;
+    /* CBC: the plaintext is the decrypted block xored with the IV */
+    if (!EVP_DecryptInit_ex(cipher, EVP_aes_256_ecb(), NULL, derived, NULL))
+        return 0;
+    EVP_CIPHER_CTX_set_padding(cipher, 0);
+    if (!EVP_DecryptUpdate(cipher, plain, &len, ctx->first_block, BLOCK_SIZE) || len != BLOCK_SIZE)
+        return 0;
+    for (i = 0; i < BLOCK_SIZE; i++)
+        plain[i] ^= ctx->iv[i];
+    return header_ok(ctx, plain);
+}
+
+long long pc_search(const pc_ctx *ctx, long long start, long long end, volatile int *stop, long long *tried)
+{
+    EVP_CIPHER_CTX *cipher = EVP_CIPHER_CTX_new();
+    char key[KEY_LENGTH + 1];
+    long long n, found = -1;
+
+    if (tried)
+        *tried = 0;
+    if (!cipher)
+        return -1;
+    for (n = start; n <= end; n++) {
+        if (stop && *stop)
+            break;
+        snprintf(key, sizeof(key), "%07llx", n);
+        if (tried)
+            (*tried)++;
+        if (check_key(ctx, cipher, key)) {
+            found = n;
+            if (stop)
+                *stop = 1;
+            break;
+        }
+    }
+    EVP_CIPHER_CTX_free(cipher);
+    return found;
+}
+
+#ifndef PC_LIBRARY
+int main(int argc, char **argv)
+{
+    pc_ctx *ctx;
+    long long start, end, found;
+    FILE *f;
+
+    if (argc != 5) {
+        fprintf(stderr, "usage: %s EnMicroMsg.db pass.txt start end\n", argv[0]);
+        return 2;
+    }
+    start = strtoll(argv[3], NULL, 16);
+    end = strtoll(argv[4], NULL, 16);
+
+    ctx = pc_open(argv[1], PAGE_SIZE, KDF_ITER, RESERVE, KDF_ALGORITHM);
+    if (!ctx) {
+        fprintf(stderr, "cannot read page 1 of %s\n", argv[1]);
+        return 2;
+    }
+    found = pc_search(ctx, start, end, NULL, NULL);
+    pc_close(ctx);
+
+    if (found < 0) {
+        printf("%07llx - %07llx: not found\n", start, end);
+        return 0;
+    }
+    printf("Key found: %07llx\n", found);
+    f = fopen(argv[2], "a");
+    if (f) {
+        fprintf(f, "%07llx\n", found);
+        fclose(f);
+    }
+    return 0;
+}
+#endif
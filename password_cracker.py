@@ -0,0 +1,52 @@
+# Python binding of libpassword_cracker.so, the native key search of password_cracker.c,
+# loaded with ctypes. Build it with:
+#    $ make
+# Works with both Python 2 and Python 3.
+
+import ctypes
+import os
+
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libpassword_cracker.so')
+
+# 0 (None for the KDF hash) selects the defaults of password_cracker.c: WeChat's settings
+DEFAULT = 0
+
+
+class NativeCracker(object):
+    '''Key search of libpassword_cracker.so, loaded with ctypes; page 1 is read once'''
+
+    def __init__(self, db_path, lib_path=LIB_PATH, page_size=DEFAULT, kdf_iter=DEFAULT, reserve=DEFAULT, kdf_algorithm=None):
+        lib = ctypes.CDLL(lib_path)
+        lib.pc_open.restype = ctypes.c_void_p
+        lib.pc_open.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_char_p]
+        lib.pc_search.restype = ctypes.c_longlong
+        lib.pc_search.argtypes = [ctypes.c_void_p, ctypes.c_longlong, ctypes.c_longlong,
+                                  ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_longlong)]
+        lib.pc_close.argtypes = [ctypes.c_void_p]
+        self.lib = lib
+
+        self.ctx = lib.pc_open(db_path.encode('utf-8'), page_size, kdf_iter, reserve,
+                               kdf_algorithm.encode('ascii') if kdf_algorithm else None)
+        if not self.ctx:
+            raise IOError('Cannot read page 1 of %s' % db_path)
+        # polled by the native search loops: set when a key is found, or by stop()
+        self.stop_flag = ctypes.c_int(0)
+
+    def search(self, start, end):
+        '''Searches the keys start to end; returns (key number or None, number of keys tried).
+        The native loop runs without the GIL, so threads search in parallel'''
+        tried = ctypes.c_longlong(0)
+        key = self.lib.pc_search(self.ctx, start, end, ctypes.byref(self.stop_flag), ctypes.byref(tried))
+        return (key if key >= 0 else None), tried.value
+
+    def stop(self):
+        self.stop_flag.value = 1
+
+    def stopped(self):
+        return bool(self.stop_flag.value)
+
+    def close(self):
+        if self.ctx:
+            self.lib.pc_close(self.ctx)
+            self.ctx = None
@@ -0,0 +1,231 @@
+# Verification of candidate keys of a SQLCipher database (EnMicroMsg.db) without SQLCipher.
+#
+# Requires PyCryptodome:
+#    $ pip install pycryptodome
+#
+# The first 16 bytes of the file are the salt of the key derivation. The rest of page 1 is
+# encrypted with AES-256-CBC, using the IV stored at the start of the reserved bytes at the
+# end of the page. Decrypting the first block gives back bytes 16 to 31 of the SQLite header,
+# whose values are known, so a candidate key is checked with one PBKDF2 and one AES block.
+# Once the key is known, decrypt_database decrypts the pages into a plain SQLite image in
+# memory, which the carver reads as it would read the file.
+# The settings of a database (page size, KDF, HMAC) are checked against the file structure by
+# structure_check, and found with a known key by probe.
+# Works with both Python 2 and Python 3.
+
+import hashlib
+import mmap
+import os
+
+# the structure checks work without it
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+
+SALT_SIZE = 16
+BLOCK_SIZE = 16
+
+# WeChat's settings: PRAGMA cipher_use_hmac = OFF; cipher_page_size = 1024; kdf_iter = 4000
+PAGE_SIZE = 1024
+KDF_ITER = 4000
+KDF_ALGORITHM = 'sha1'
+RESERVE = 16
+
+# settings of the SQLCipher versions: (name, page size, kdf_iter, KDF hash, reserved bytes);
+# the reserved bytes hold the IV, then the HMAC when it is on, rounded up to the AES block
+CIPHER_SETTINGS = [
+    ('wechat', 1024, 4000, 'sha1', 16),
+    ('sqlcipher2', 1024, 4000, 'sha1', 48),
+    ('sqlcipher3', 1024, 64000, 'sha1', 48),
+    ('sqlcipher4', 4096, 256000, 'sha512', 80),
+]
+# values tried by probe
+PAGE_SIZES = [512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+KDF_ITERATIONS = [4000, 64000, 256000]
+KDF_ALGORITHMS = ['sha1', 'sha256', 'sha512']
+RESERVES = [16, 32, 48, 64, 80]
+
+# keys derived together by KeyVerifier.find
+BATCH_SIZE = 64
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+class KeyVerifier(object):
+    '''Checks candidate keys against page 1 of a SQLCipher database'''
+
+    def __init__(self, db_path, page_size=PAGE_SIZE, kdf_iter=KDF_ITER, reserve=RESERVE, kdf_algorithm=KDF_ALGORITHM):
+        if AES is None:
+            raise ImportError('pycryptodome is required: pip install pycryptodome')
+        self.page_size = page_size
+        self.kdf_iter = kdf_iter
+        self.reserve = reserve
+        self.kdf_algorithm = kdf_algorithm
+
+        # the salt, the first encrypted block and the IV are read once
+        with open(db_path, 'rb') as f:
+            page = bytearray(f.read(page_size))
+        if len(page) < page_size:
+            raise ValueError('%s is smaller than one page' % db_path)
+        self.salt = bytes(page[:SALT_SIZE])
+        self.first_block = bytes(page[SALT_SIZE:SALT_SIZE + BLOCK_SIZE])
+        self.iv = page[page_size - reserve:page_size - reserve + BLOCK_SIZE]
+
+    def derive(self, key):
+        '''Returns the AES key of a passphrase: PBKDF2-HMAC (SHA-1 by default) over the salt'''
+        return derive_key(key, self.salt, self.kdf_iter, self.kdf_algorithm)
+
+    def check_derived(self, derived):
+        '''Tells whether an AES key decrypts the first block to a valid SQLite header'''
+        return header_ok(first_plain_block(derived, self.first_block, self.iv), self.page_size, self.reserve)
+
+    def check(self, key):
+        '''Tells whether a passphrase is the key of the database'''
+        return self.check_derived(self.derive(key))
+
+    def derive_batch(self, keys, executor=None):
+        '''Returns the AES keys of several passphrases; with an executor, they are derived by its threads
+        in parallel, as hashlib.pbkdf2_hmac releases the GIL'''
+        if executor is None:
+            return [self.derive(key) for key in keys]
+        return list(executor.map(self.derive, keys))
+
+    def find(self, keys, executor=None, batch_size=BATCH_SIZE, stop=None):
+        '''Returns the first of the passphrases which is the key of the database, None if none is;
+        the keys are derived in batches, and the search ends early once stop (an Event) is set'''
+        keys = list(keys)
+        for i in range(0, len(keys), batch_size):
+            if stop is not None and stop.is_set():
+                break
+            batch = keys[i:i + batch_size]
+            for key, derived in zip(batch, self.derive_batch(batch, executor)):
+                if self.check_derived(derived):
+                    return key
+        return None
+
+
+def derive_key(key, salt, kdf_iter=KDF_ITER, kdf_algorithm=KDF_ALGORITHM):
+    '''PBKDF2-HMAC of a passphrase over the salt of the database, as SQLCipher derives its AES key'''
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.pbkdf2_hmac(kdf_algorithm, key, salt, kdf_iter, 32)
+
+
+def first_plain_block(derived, first_block, iv):
+    '''Decrypts the first encrypted block of page 1'''
+    block = bytearray(AES.new(derived, AES.MODE_ECB).decrypt(first_block))
+    # CBC: the plaintext is the decrypted block xored with the IV
+    return bytearray(b ^ v for b, v in zip(block, bytearray(iv)))
+
+
+def header_ok(plain, page_size, reserve):
+    '''Checks bytes 16 to 23 of a decrypted SQLite header: page size, format versions, reserved bytes, payload fractions'''
+    #the reserved bytes hold at least the IV; databases created with HMAC before it was turned off declare more
+    size = (plain[0] << 8) | plain[1]
+    if size == 1:
+        size = 65536
+    return (size == page_size and plain[2] in (1, 2) and plain[3] in (1, 2)
+            and plain[4] >= reserve and plain[5] == 64 and plain[6] == 32 and plain[7] == 32)
+
+
+def decrypt_page(derived, page, reserve=RESERVE, first=False):
+    '''Decrypts one page with an AES key; the salt of page 1 is replaced by the SQLite magic string'''
+    size = len(page)
+    start = SALT_SIZE if first else 0
+    iv = bytes(page[size - reserve:size - reserve + BLOCK_SIZE])
+    plain = AES.new(derived, AES.MODE_CBC, iv).decrypt(bytes(page[start:size - reserve]))
+    # the reserved bytes are kept, the header of the database still declares them
+    return (SQLITE_HEADER if first else b'') + plain + bytes(page[size - reserve:])
+
+
+def page_decrypter(db_path, key, page_size=PAGE_SIZE, kdf_iter=KDF_ITER, reserve=RESERVE, kdf_algorithm=KDF_ALGORITHM):
+    '''Returns a function decrypting a page image given its page number, e.g. the frames of the WAL file of the database'''
+    #the pages of the WAL file and journal are encrypted with the key derived from the salt of the database
+    derived = KeyVerifier(db_path, page_size, kdf_iter, reserve, kdf_algorithm).derive(key)
+    return lambda pageno, page: decrypt_page(derived, page, reserve, pageno == 1)
+
+
+def decrypt_database(db_path, key, page_size=PAGE_SIZE, kdf_iter=KDF_ITER, reserve=RESERVE, use_mmap=True, kdf_algorithm=KDF_ALGORITHM):
+    '''Returns the plain SQLite image of an encrypted database, None if the key is wrong.
+    The pages are decrypted one at a time into an anonymous memory map (a bytearray without use_mmap),
+    which the kernel can page out and which forked processes share without copying'''
+    verifier = KeyVerifier(db_path, page_size, kdf_iter, reserve, kdf_algorithm)
+    derived = verifier.derive(key)
+    if not verifier.check_derived(derived):
+        return None
+
+    size = os.path.getsize(db_path)
+    size -= size % page_size
+    image = mmap.mmap(-1, size) if use_mmap and size else bytearray(size)
+    with open(db_path, 'rb') as f:
+        for offset in range(0, size, page_size):
+            image[offset:offset + page_size] = decrypt_page(derived, f.read(page_size), reserve, offset == 0)
+    return image
+
+
+def structure_check(db_path, page_size=PAGE_SIZE):
+    '''Returns the problems of the file structure which rule out a SQLCipher database with this page size, an empty list if there are none'''
+    if is_plain_database(db_path):
+        return ['%s is a plain SQLite database, it is not encrypted' % db_path]
+    size = os.path.getsize(db_path)
+    problems = []
+    if size < page_size:
+        problems.append('%s (%d bytes) is smaller than one page of %d bytes' % (db_path, size, page_size))
+    elif size % page_size:
+        problems.append('the size of %s (%d bytes) is not a multiple of the page size %d' % (db_path, size, page_size))
+    if problems:
+        sizes = plausible_page_sizes(db_path)
+        problems.append('page sizes the file size allows: %s' % (', '.join(str(s) for s in sizes) or 'none'))
+    return problems
+
+
+def is_plain_database(db_path):
+    '''Tells whether the file starts with the header of a plain SQLite database'''
+    with open(db_path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def plausible_page_sizes(db_path):
+    '''Page sizes whose multiple the file size is'''
+    size = os.path.getsize(db_path)
+    return [p for p in PAGE_SIZES if p <= size and size % p == 0]
+
+
+def settings_name(page_size, kdf_iter, kdf_algorithm, reserve):
+    '''Name of the SQLCipher version with these settings, 'custom' if none'''
+    for name, p, i, a, r in CIPHER_SETTINGS:
+        if (p, i, a, r) == (page_size, kdf_iter, kdf_algorithm, reserve):
+            return name
+    return 'custom'
+
+
+def probe(db_path, keys, page_sizes=None, iterations=KDF_ITERATIONS, algorithms=KDF_ALGORITHMS, reserves=RESERVES):
+    '''Finds the settings of a database with known or likely keys; returns a dict of the key and its
+    settings (page_size, kdf_iter, kdf_algorithm, reserve, hmac, version), None if no key opens it.
+    The AES key depends only on the KDF, so each key is derived once per KDF hash and iteration count;
+    the page sizes and reserved bytes are then told apart by where the IV must be for page 1 to decrypt'''
+    if page_sizes is None:
+        page_sizes = plausible_page_sizes(db_path)
+    with open(db_path, 'rb') as f:
+        head = f.read(max(page_sizes or [0]))
+    salt, first_block = head[:SALT_SIZE], head[SALT_SIZE:SALT_SIZE + BLOCK_SIZE]
+
+    # the usual settings first, each KDF once; every key is tried with the cheap KDFs before any key with the costly ones
+    combos = [(i, a) for n, p, i, a, r in CIPHER_SETTINGS]
+    combos += [(i, a) for a in algorithms for i in iterations]
+    keys = list(keys)
+    for kdf_iter, kdf_algorithm in list(dict.fromkeys(combos)):
+        for key in keys:
+            derived = derive_key(key, salt, kdf_iter, kdf_algorithm)
+            for page_size in page_sizes:
+                for reserve in reserves:
+                    if reserve >= page_size - SALT_SIZE - BLOCK_SIZE:
+                        continue
+                    iv = head[page_size - reserve:page_size - reserve + BLOCK_SIZE]
+                    if header_ok(first_plain_block(derived, first_block, iv), page_size, reserve):
+                        return {'key': key, 'page_size': page_size, 'kdf_iter': kdf_iter, 'kdf_algorithm': kdf_algorithm,
+                                'reserve': reserve, 'hmac': reserve > BLOCK_SIZE,
+                                'version': settings_name(page_size, kdf_iter, kdf_algorithm, reserve)}
+    return None
@@ -24,29 +24,329 @@ import binascii
 import time
 import argparse
 import sys
+import copy
 import csv
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import pathlib
 from collections import defaultdict
 import re
-zhPattern = re.compile(u'[\u4e00-\u9fa5]+')
+try:
+    import numpy as np
+except ImportError:
+    #the vectorized candidate pre-filter is skipped without numpy
+    np = None
+
+#serial types with a fixed-size payload: serial: size; 1 to 6 are big-endian signed integers, 7 is a float
+SERIAL_SIZES = {1: 1, 2: 2, 3: 3, 4: 4, 5: 6, 6: 8, 7: 8}
 
-global_data_sets = [['id','message']]
-global_undelete_data = []
 global_count = 0
 
+#serial types of text and blobs can't exceed this value
+MAX_SERIAL = 1000000
+
+#UTF-8 byte sequences of the characters a message may hold: printable ASCII, tab and newlines, and the well-formed
+#multi-byte sequences (without overlong forms, surrogates and code points past U+10FFFF)
+UTF8_CHAR = (rb'[\t\n\r\x20-\x7e]|[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]|[\xe1-\xec\xee\xef][\x80-\xbf]{2}'
+             rb'|\xed[\x80-\x9f][\x80-\xbf]|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}|\xf4[\x80-\x8f][\x80-\xbf]{2}')
+#UTF-8 byte sequences of the script classes, a message must hold a character of one of the selected ones
+SCRIPT_CLASSES = {
+    #CJK unified ideographs, U+4E00 to U+9FFF
+    'cjk': rb'\xe4[\xb8-\xbf][\x80-\xbf]|[\xe5-\xe9][\x80-\xbf]{2}',
+    #ASCII letters, and the Latin-1 and Latin Extended letters, U+00C0 to U+024F
+    'latin': rb'[A-Za-z]|\xc3[\x80-\xbf]|[\xc4-\xc8][\x80-\xbf]|\xc9[\x80-\x8f]',
+    #emoji, U+1F300 to U+1FAFF, and the miscellaneous symbols and dingbats, U+2600 to U+27BF
+    'emoji': rb'\xf0\x9f[\x8c-\xab][\x80-\xbf]|\xe2[\x98-\x9e][\x80-\xbf]',
+}
+DEFAULT_SCRIPTS = ('cjk',)
+REPLACEMENT_CHAR = u'\ufffd'.encode('utf-8')
+
+#longest interval between two checkpoints of RowWriter, in seconds
+CHECKPOINT_SECONDS = 30
+
+#overflow pages kept in memory by RecordRetriever, shared by the chains of all the candidate rows
+OVERFLOW_CACHE_PAGES = 4096
+
+#readings of a corrupted row tried by RecordRetriever: sizes of the values of its lost columns
+CORRUPTED_FANOUT = 8
+
+#write-ahead log: magic numbers of the header (the last bit tells the byte order of the checksums), header and frame header sizes
+WAL_MAGIC = (0x377f0682, 0x377f0683)
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+#rollback journal: magic string of a segment header, and the sector size assumed when the header has been zeroed
+JOURNAL_MAGIC = b'\xd9\xd5\x05\xf9\x20\xa1\x63\xd7'
+JOURNAL_SECTOR_SIZE = 512
+
+def vector_varints(b, positions):
+    '''Decodes the varints of up to 3 bytes starting at each of the given positions of a numpy array of bytes; returns values, lengths and validity'''
+    a0, a1, a2 = b[positions], b[positions+1], b[positions+2]
+    one = a0 < 0x80
+    two = ~one & (a1 < 0x80)
+    three = ~one & ~two & (a2 < 0x80)
+    value = np.where(one, a0, np.where(two, ((a0-0x80)<<7)+a1, ((a0-0x80)<<14)+((a1-0x80)<<7)+a2))
+    length = np.where(one, 1, np.where(two, 2, 3))
+    #as in BufferVarintReader.varint_integer, a leading group of 0 bits is not valid
+    return value, length, (one | two | three) & (a0 != 0x80)
+
+def message_filter(scripts=DEFAULT_SCRIPTS):
+    '''Returns a function telling whether bytes start with valid UTF-8 text up to a character of the given script classes'''
+
+    #A precompiled pattern goes over the bytes without decoding them, and stops at the first character of the scripts:
+    #usually the first one of a message, so that most candidates are accepted or rejected after a few bytes. The
+    #characters before it can't be of the scripts, so the pattern never backtracks.
+    script = b'|'.join(SCRIPT_CLASSES[name] for name in scripts)
+    return re.compile(b'(?:(?!' + script + b')(?:' + UTF8_CHAR + b'))*(?:' + script + b')').match
+
+
+def script_classes(value):
+    '''Parses a comma-separated list of script classes'''
+    scripts = tuple(name.strip().lower() for name in value.split(',') if name.strip())
+    unknown = [name for name in scripts if name not in SCRIPT_CLASSES]
+    if unknown or not scripts:
+        raise argparse.ArgumentTypeError('unknown script classes: %s (choose among %s)' % (', '.join(unknown) or value, ', '.join(sorted(SCRIPT_CLASSES))))
+    return scripts
+
+
 def p(f):
     print('%s.%s(): %s' % (f.__module__, f.__name__, f()))
 
-def write():
-    with open('msg.csv','a',encoding='utf8') as out:
-        csv_write = csv.writer(out)
-        csv_write.writerows(global_data_sets)
+p(sys.getdefaultencoding)
 
-def write_data(data):
-    with open('deleted.csv','a',encoding='utf8') as out:
-        csv_write = csv.writer(out)
-        csv_write.writerows(data)
+def open_buffer(fileobj, use_mmap=True):
+    '''Returns a read-only buffer over the whole file: a memory map when possible, the file contents otherwise'''
+    #mmap cannot map empty files, and some filesystems do not support it at all
+    if use_mmap and os.fstat(fileobj.fileno()).st_size:
+        try:
+            return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as ex:
+            print('Cannot memory-map database file, reading it into memory instead:', ex)
+    fileobj.seek(0)
+    return fileobj.read()
+
+class BloomFilter:
+    '''Set membership in a fixed-size bit array, with a given false-positive rate and no false negatives'''
+
+    def __init__(self, capacity, fp_rate):
+        #optimal number of bits and hash functions for the expected number of items
+        capacity = max(capacity, 1)
+        self.size = max(8, int(math.ceil(-capacity*math.log(fp_rate)/math.log(2)**2)))
+        self.hashes = max(1, int(round(self.size/capacity*math.log(2))))
+        self.bits = bytearray((self.size+7)//8)
+
+
+    def positions(self, digest):
+        '''Bit positions of a 128-bit digest, by double hashing'''
+        h1, h2 = digest >> 64, digest & 0xffffffffffffffff
+        return [(h1 + i*h2) % self.size for i in range(self.hashes)]
+
+
+    def add(self, digest):
+        for pos in self.positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+
+    def __contains__(self, digest):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(digest))
+
+
+class LiveMessages:
+    '''Content hashes of the messages in the live rows of a table, to tell deleted rows from live ones'''
+
+    def __init__(self, dbs, root_no, column=1, bloom=False, fp_rate=0.001, batch_size=10000):
+        #the live rows are streamed from the database, only their hash is kept:
+        #64-bit hashes in a set, or 128-bit hashes in a Bloom filter sized on the number of rows
+        if bloom:
+            self.digest_size = 16
+            self.digests = BloomFilter(dbs.count_cells(root_no), fp_rate)
+        else:
+            self.digest_size = 8
+            self.digests = set()
+
+        for row in dbs.table_cells(root_no, batch_size):
+            if row[column] is not None: self.add(row[column])
+
+
+    def digest(self, message):
+        #carved blobs reach here as text (see RecordRetriever.compatible_strings), live ones are converted the same way
+        if isinstance(message, bytes): message = str(message)[2:-1]
+        message = str(message).encode('utf8')
+        return int.from_bytes(hashlib.blake2b(message, digest_size=self.digest_size).digest(), 'big')
+
+
+    def add(self, message):
+        self.digests.add(self.digest(message))
+
+
+    def __contains__(self, message):
+        return self.digest(message) in self.digests
+
+
+class Checkpoint:
+    '''Page ranges already scanned and size of the output files, saved next to the output so that a scan can be resumed'''
+
+    def __init__(self, path, dbpath, dbsize, pagesize, options=None):
+        self.path = path
+        #identifies the database the checkpoint belongs to, and the options of the scan which change the rows found in a page
+        self.database = {'path': os.path.abspath(dbpath), 'size': dbsize, 'pagesize': pagesize}
+        self.database.update(options or {})
+        #sorted, non-overlapping [first, last] page ranges
+        self.ranges = []
+        #output file: size in bytes when the checkpoint was saved
+        self.offsets = {}
+        #number of the older page images of the WAL file and journal already carved, after the pages of the database
+        self.history = 0
+
+
+    def load(self):
+        '''Reads the checkpoint file; returns False if there is none. Raises ValueError if it belongs to another database
+        or scan, or if an output file it records is missing or shorter than when it was saved'''
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        database = saved.get('database', {})
+        if database != self.database:
+            different = sorted(key for key in set(database) | set(self.database) if database.get(key) != self.database.get(key))
+            raise ValueError('%s belongs to another database or scan (%s)' % (self.path, ', '.join(different)))
+        for path, size in saved['outputs'].items():
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                raise ValueError('%s has been removed or truncated since %s was saved' % (path, self.path))
+        self.ranges = saved['pages']
+        self.offsets = saved['outputs']
+        self.history = saved.get('history', 0)
+        return True
+
+
+    def add(self, pages):
+        '''Marks pages as scanned'''
+        ranges = sorted(self.ranges + [[p, p] for p in pages])
+        self.ranges = []
+        for first, last in ranges:
+            if self.ranges and first <= self.ranges[-1][1]+1:
+                self.ranges[-1][1] = max(self.ranges[-1][1], last)
+            else:
+                self.ranges.append([first, last])
+
+
+    def __contains__(self, pageno):
+        return any(first <= pageno <= last for first, last in self.ranges)
+
+
+    def save(self, offsets):
+        '''Writes the checkpoint file, replacing the previous one atomically'''
+        self.offsets = offsets
+        with open(self.path+'.tmp', 'w') as f:
+            json.dump({'database': self.database, 'pages': self.ranges, 'outputs': offsets, 'history': self.history}, f)
+        os.replace(self.path+'.tmp', self.path)
+
+
+class RowWriter:
+    '''Streams the rows recovered from each table to its pair of output files in buffered batches'''
+
+    def __init__(self, live, fmt='csv', flush_size=1000, checkpoint=None, resume=False, flush_seconds=CHECKPOINT_SECONDS):
+        #table name: messages of the live rows; recovered rows whose key is among them don't go to the deleted file
+        self.live = live
+        self.ext = fmt
+        self.delimiter = ',' if fmt == 'csv' else '\t'
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.time()
+        self.checkpoint = checkpoint
+        self.resume = resume
+
+        #output path: [file, csv writer, queued rows]
+        self.outputs = {}
+        self.queued = 0
+        self.pages = []
+        self.history = None
+
+        #on resume, drop whatever was written after the last checkpoint
+        if resume:
+            for path, size in checkpoint.offsets.items():
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+
+    def paths(self, profile):
+        '''Returns the paths of the files of all the rows and of the deleted rows of a table, opening them if needed'''
+        return self.open_paths(profile, [stem+'.'+self.ext for stem in profile.outputs])
+
+
+    def open_paths(self, profile, paths):
+        '''Opens the output files of a table which are not open yet; returns their paths'''
+        for path in paths:
+            if path not in self.outputs:
+                out = open(path, 'a', encoding='utf8')
+                #headers are already in the files of a resumed scan
+                header = [] if self.resume and path in self.checkpoint.offsets else [profile.header]
+                self.outputs[path] = [out, csv.writer(out, delimiter=self.delimiter), header]
+        return paths
+
+
+    def add(self, profile, rows):
+        '''Queues rows recovered from a table for output'''
+        msg_path, deleted_path = self.paths(profile)
+        live = self.live.get(profile.table, ())
+        for row in rows:
+            self.outputs[msg_path][2].append(row)
+            if row[profile.key] not in live: self.outputs[deleted_path][2].append(row)
+        self.queued += len(rows)
+
+
+    def add_corrupted(self, profile, rows):
+        '''Queues partial rows recovered from a table for output to its file of corrupted rows, next to its first output file;
+        the ones whose key is left and among the live rows are dropped'''
+        path, = self.open_paths(profile, [profile.outputs[0]+'_corrupted.'+self.ext])
+        live = self.live.get(profile.table, ())
+        rows = [row for row in rows if row[profile.key] is None or row[profile.key] not in live]
+        self.outputs[path][2].extend(rows)
+        self.queued += len(rows)
+
+
+    def page_done(self, pageno):
+        '''Marks a page as fully scanned; flushes the queued rows once there are at least flush_size of them, or flush_seconds
+        after the last flush, so that a scan finding few rows is checkpointed as well'''
+        self.pages.append(pageno)
+        if self.queued >= self.flush_size or time.time() - self.last_flush >= self.flush_seconds: self.flush()
+
+
+    def history_done(self, count):
+        '''Marks the first count older page images as carved; flushes as page_done does'''
+        self.history = count
+        if self.queued >= self.flush_size or time.time() - self.last_flush >= self.flush_seconds: self.flush()
+
+
+    def flush(self):
+        '''Writes the queued rows to disk, then checkpoints the pages they come from'''
+        for out, writer, rows in self.outputs.values():
+            writer.writerows(rows)
+            del rows[:]
+            out.flush()
+        self.queued = 0
+
+        if self.checkpoint is not None:
+            self.checkpoint.add(self.pages)
+            if self.history is not None: self.checkpoint.history = self.history
+            #the outputs of a resumed scan which have not been written to again keep their saved size
+            offsets = dict(self.checkpoint.offsets)
+            offsets.update((path, os.fstat(output[0].fileno()).st_size) for path, output in self.outputs.items())
+            self.checkpoint.save(offsets)
+        self.pages = []
+        self.last_flush = time.time()
+
+
+    def close(self):
+        '''Flushes the remaining rows and closes the output files'''
+        self.flush()
+        for output in self.outputs.values():
+            output[0].close()
 
-p(sys.getdefaultencoding)
 
 class NullWriter:
     '''Disable print in non-verbose mode'''
@@ -141,24 +441,120 @@ class VarintReader:
         return [self.varint_from_file() for i in range(n)]
 
 
+class BufferVarintReader:
+    '''Functions for extracting varints straight from an in-memory buffer (mmap or bytes) by index'''
+    def __init__(self, buf):
+        self.buf = buf
+
+
+    def varint_from_buffer(self, offset):
+        '''Same as VarintReader.varint_from_file, reading at the given offset; returns the value and the offset right after the varint'''
+
+        buf = self.buf
+        a0 = buf[offset]
+        if a0 <= 240: return a0, offset+1
+
+        elif a0 <= 248: return 240+256*(a0-241)+buf[offset+1], offset+2
+
+        elif a0 == 249: return 2288+256*buf[offset+1]+buf[offset+2], offset+3
+
+        #A0 between 250 and 255: the result is the next A0-247 bytes as a big-endian integer
+        length = a0-247
+        if offset+1+length > len(buf): raise IndexError('varint out of buffer')
+        return int.from_bytes(buf[offset+1:offset+1+length], 'big'), offset+1+length
+
+
+    def varint_integer(self, offset):
+        '''Same as VarintReader.varint_integer, reading at the given offset; returns the value (None if longer than 3 bytes) and the offset right after the varint'''
+
+        #big-endian groups of 7 bits, the high bit of each byte flags that another byte follows
+        buf = self.buf
+        a0 = buf[offset]
+        if a0 <= 127: return a0, offset+1
+        #SQLite never writes a leading group of 0 bits
+        if a0 == 128: return None, offset+1
+
+        a1 = buf[offset+1]
+        if a1 <= 127: return a1 + (a0-128)*128, offset+2
+
+        a2 = buf[offset+2]
+        if a2 <= 127: return a2 + (a1-128)*128 + (a0-128)*128*128, offset+3
+
+        return None, offset+3
+
+
+    def n_varints(self, offset, n):
+        '''Read a specified number of varints starting at the given offset; returns the list of values and the offset after the last one'''
+        values = []
+        for i in range(n):
+            value, offset = self.varint_from_buffer(offset)
+            values.append(value)
+        return values, offset
+
+
 ###############################################################################################################################################
 
 
 class DBSchema:
     '''Interactions with the database tables, validation of data according to the tables'''
 
-    def __init__(self, dbpath):
+    def __init__(self, dbpath, tables=None, profiles=None, registry=None, selected=None, image=None):
+        self.dbpath = dbpath
+        #image of a database decrypted in memory, opened instead of the file, and its connection
+        self.image = image
+        self.conn = None
+        #(table description, mode): SerialValidator
+        self.validators = {}
+
+        #scan workers receive the tables and profiles already described by the main process
+        if tables is not None:
+            self.tables = tables
+            self.profiles = profiles
+            return
+
         #connect to database
-        self.cur = sqlite3.connect(dbpath).cursor()
+        self.cur = self.connect().cursor()
         #get schema of the database
         self.schema = self.get_schema()
         #description of the tables
         self.tables = self.table_info(self.schema)
-        #visible records in the tables
-        self.cells = self.table_cells(self.tables)
-        global_undelete_data.extend(self.cells[21])
+        #profiles of the tables to carve
+        if registry is None: registry = SchemaRegistry()
+        self.profiles = registry.resolve(self.tables, selected)
         #disconnect
-        self.cur.connection.close()
+        self.disconnect(self.cur.connection)
+
+
+    def connect(self):
+        '''Opens the database file, read-only; or returns the connection to an in-memory copy of the image, made once'''
+
+        #the file is opened as immutable: SQLite neither reads nor checkpoints its WAL file, and never rolls back its journal
+        if self.image is None: return sqlite3.connect(pathlib.Path(os.path.abspath(self.dbpath)).as_uri() + '?mode=ro&immutable=1', uri=True)
+        if self.conn is None:
+            #the image of a database in WAL mode can't be opened without its WAL file: it is opened in rollback journal mode,
+            #patching the image in place (the format version bytes are not carved) or a copy of it if it is read-only
+            image = self.image
+            if image[18] == 2 or image[19] == 2:
+                try:
+                    image[18:20] = b'\x01\x01'
+                except TypeError:
+                    image = bytearray(image)
+                    image[18:20] = b'\x01\x01'
+            self.conn = sqlite3.connect(':memory:')
+            self.conn.deserialize(image)
+        return self.conn
+
+
+    def disconnect(self, conn):
+        '''Closes a connection returned by connect, unless it is the one to the image, kept until close'''
+        if conn is not self.conn: conn.close()
+
+
+    def close(self):
+        '''Frees the in-memory copy of the image, once the live rows have been read'''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
 
     def get_schema(self):
@@ -185,20 +581,31 @@ class DBSchema:
         #the key-value pairs of the dictionary tables follow the structure:
         #root number:(table name, [(cid1, name1, type1, notnull1, dftl1, pk1), ..., (cidN, nameN, typeN, notnullN, dfltN, pkN)]
         print(tables)
-        tables = {21: ('FTS5IndexMessage_content', [(0, 'id', 'INTEGER', 0, None, 1), (1, 'c0', 'TEXT', 0, None, 0)])}
         return tables
 
 
-    def table_cells(self, tables):
-        '''Returns the non-deleted records for each table'''
+    def table_cells(self, root_no, batch_size=10000):
+        '''Yields the non-deleted records of a table, fetching them in batches of batch_size rows'''
 
-        cells = {}
-        for root_no in tables:
-            cells[root_no]=self.cur.execute('SELECT * FROM '+tables[root_no][0]).fetchall()
-            
-        #the key-values pairs of the dictionary cells follow the structure:
-        #root number: list of rows
-        return cells
+        conn = self.connect()
+        try:
+            cur = conn.execute('SELECT * FROM '+self.tables[root_no][0])
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows: break
+                for row in rows: yield row
+        finally:
+            self.disconnect(conn)
+
+
+    def count_cells(self, root_no):
+        '''Returns the number of non-deleted records of a table'''
+
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM '+self.tables[root_no][0]).fetchone()[0]
+        finally:
+            self.disconnect(conn)
 
 
     def data_check(self, piece):
@@ -219,78 +626,200 @@ class DBSchema:
     def validate_serials(self, serials, tbl_desc, skip, nostrict):
         '''Confronts an iterable of serial type varints with the table schema to see if they corrispond'''
 
-        for i in range(len(serials)):
+        #the rules of each column are precompiled once per table and mode
+        return self.validator(tbl_desc, nostrict).validate(serials, skip)
 
-            #first associate the serial number with the corresponding column
-            serial = serials[i]
-            col_desc = tbl_desc[i+skip]            
 
-            #check the type of the column and if notnull is set
-            col_type = col_desc[2].lower()
-            col_notnull = col_desc[3]
+    def validator(self, tbl_desc, nostrict):
+        '''Returns the SerialValidator of a table description, compiling it the first time'''
 
-            #get the column affinity
-            col_affinity = self.get_col_aff(col_type)
+        key = (tuple(tbl_desc), bool(nostrict))
+        if key not in self.validators: self.validators[key] = SerialValidator(tbl_desc, nostrict)
+        return self.validators[key]
 
-            #in non-strict mode, the function follows sqlite's documentations guidelines about data types
-            #possibly stored by columns with certain affinities; this makes the check much less strict
-            #as it is possible to find more data types per affinity 
-            if True:
-                    
-                if serial == 0 and not col_notnull: continue
 
-                #integer-, real- and numeric-affinity columns can store data in any possible way
-                elif col_affinity in ['INTEGER', 'NUMERIC', 'REAL', 'NONE'] and serial < 12: continue
+    @staticmethod
+    def get_col_aff(col_type):
+        '''Returns the column affinity for the given column type'''
+        #This algorithm follows the description of SQLite documentation
+        #it is based on certain substrings contained in the column type string
 
-                #text- and none-affinity columns can store strings and blob
-                elif col_affinity == 'NONE' and serial >= 12: continue
+        if 'int' in col_type: return 'INTEGER'
 
-                elif col_affinity == 'TEXT' and serial >= 13: continue
+        elif 'char' in col_type or 'text' in col_type or 'clob' in col_type: return 'TEXT'
 
-                else: return False
+        elif not col_type or 'blob' in col_type: return 'NONE'
 
-            #in strict mode, the function assumes a reasonable use of the column types;
-            #that is, it assumes that columns with INTEGER, REAL and NUMERIC affinity
-            #actually store numbers, TEXT stores strings, and NONE stores blob;
-            else:
+        elif 'real' in col_type or 'floa' in col_type or 'doub' in col_type: return 'REAL'
+
+        else: return 'NUMERIC'
 
-                #data can only be null if NOT NULL is not set
-                if serial == 0 and not col_notnull: continue
-                
-                elif col_affinity == 'INTEGER' and serial in [1, 2, 3, 4, 5, 6, 8, 9]: continue
 
-                #the validation for real includes the serial types for integer types smaller than 8 bytes because in certain cases
-                #the floating point number can be converted to integer
-                elif col_affinity == 'REAL' and serial in [1, 2, 3, 4, 5, 7, 8, 9]:continue
+############################################################################################################################################################
 
-                elif col_affinity == 'NUMERIC' and serial in [1, 2, 3, 4, 5, 6, 7, 8, 9]: continue
 
-                elif col_affinity == 'NONE' and serial >= 12 and not serial%2: continue
+class SerialValidator:
+    '''Serial types accepted by each column of a table, precompiled for one strictness mode'''
 
-                elif col_affinity == 'TEXT' and serial >= 13 and serial%2: continue
+    #serial types below 12 which strict mode accepts for each column affinity
+    STRICT = {'INTEGER': [1, 2, 3, 4, 5, 6, 8, 9], 'REAL': [1, 2, 3, 4, 5, 7, 8, 9], 'NUMERIC': range(1, 10), 'TEXT': [], 'NONE': []}
 
-                else: return False
-                
-        #return the validated serials plus a code 8 for each skipped one
+    def __init__(self, tbl_desc, nostrict, rowid=None, message=None):
+        #for each column: (bitmap of the accepted serials below 12, nullable, accepts text, accepts blob)
+        self.columns = []
+        for cid, name, col_type, notnull, dflt, pk in tbl_desc:
+            #the rowid alias is always stored as null, the message column always as text
+            if cid == rowid: self.columns.append((1, True, False, False))
+            elif cid == message: self.columns.append((0, False, True, False))
+            else: self.columns.append(self.column_rules(DBSchema.get_col_aff(col_type.lower()), not notnull, nostrict))
+
+
+    @classmethod
+    def column_rules(cls, affinity, nullable, nostrict):
+        '''Returns (bitmap of the accepted serials below 12, nullable, accepts text, accepts blob) for a column'''
+
+        #in non-strict mode, the rules follow sqlite's documentations guidelines about data types
+        #possibly stored by columns with certain affinities: numeric affinities store any number,
+        #text and none affinities store strings and blobs
+        if nostrict:
+            small = [] if affinity == 'TEXT' else range(1, 10)
+            text = blob = affinity in ('TEXT', 'NONE')
+
+        #in strict mode, it assumes that columns with INTEGER, REAL and NUMERIC affinity
+        #actually store numbers, TEXT stores strings, and NONE stores blob
+        else:
+            small = cls.STRICT[affinity]
+            text, blob = affinity == 'TEXT', affinity == 'NONE'
+
+        mask = sum(1 << serial for serial in small) | (1 if nullable else 0)
+        return (mask, nullable, text, blob)
+
+
+    def allowed(self, cid, serial):
+        '''Tells whether a column accepts a serial type'''
+        mask, nullable, text, blob = self.columns[cid]
+        if serial < 12: return bool(mask >> serial & 1)
+        return serial <= MAX_SERIAL and (text if serial & 1 else blob)
+
+
+    def validate(self, serials, skip=0):
+        '''Returns the serials if each of them is accepted by its column, counting columns from skip; False otherwise'''
+        for i, serial in enumerate(serials):
+            if not self.allowed(i+skip, serial): return False
         return serials
 
 
-        
+    def tail(self, skip):
+        '''Returns a validator of the columns from skip on, for the rows whose first serials are lost'''
+        validator = copy.copy(self)
+        validator.columns = self.columns[skip:]
+        return validator
 
-    def get_col_aff(self, col_type):
-        '''Returns the column affinity for the given column type'''
-        #This algorithm follows the description of SQLite documentation
-        #it is based on certain substrings contained in the column type string
 
-        if 'int' in col_type: return 'INTEGER'
+    def first_bytes(self):
+        '''Returns the bytes which can start the varint of the serial of the first column'''
+        mask, nullable, text, blob = self.columns[0]
+        return bytes(b for b in range(256) if (b < 128 and self.allowed(0, b)) or (b > 128 and (text or blob)))
 
-        elif 'char' in col_type or 'text' in col_type or 'clob' in col_type: return 'TEXT'
 
-        elif not col_type or 'blob' in col_type: return 'NONE'
+    def vector_allowed(self, cid, serials):
+        '''Same as allowed, for a numpy array of serials'''
+        mask, nullable, text, blob = self.columns[cid]
+        small = (mask >> np.minimum(serials, 11)) & 1 == 1
+        large = np.where(serials & 1, text, blob) & (serials <= MAX_SERIAL)
+        return np.where(serials < 12, small, large)
 
-        elif 'real' in col_type or 'floa' in col_type or 'doub' in col_type: return 'REAL'
 
-        else: return 'NUMERIC'
+class SchemaProfile:
+    '''How to carve a table: column type overrides, the column holding the message and the column telling deleted rows from live ones'''
+
+    def __init__(self, table, types=None, message=None, key=None, header=None, outputs=None):
+        self.table = table
+        #column name: declared type to use instead of the one in the database
+        self.types = types or {}
+        #the message column is only accepted if it decodes to a message; the key column is looked up among the live rows
+        self.message_name = message
+        self.key_name = key or message
+        self.header = header
+        #stems of the files of all the recovered rows and of the deleted ones
+        self.outputs = tuple(outputs) if outputs else (table, table+'_deleted')
+        self.columns = []
+
+
+    def bind(self, table_desc):
+        '''Returns a copy of the profile applied to the columns of the table as described by PRAGMA table_info'''
+
+        bound = copy.copy(self)
+        bound.columns = [(cid, name, self.types.get(name, ctype), notnull, dflt, pk) for cid, name, ctype, notnull, dflt, pk in table_desc]
+        names = [col[1] for col in bound.columns]
+
+        #a single INTEGER PRIMARY KEY column is an alias of the rowid: it is stored as a null
+        pks = [col for col in bound.columns if col[5]]
+        bound.rowid = pks[0][0] if len(pks) == 1 and pks[0][2].strip().upper() == 'INTEGER' else None
+
+        #without a key column, the message column is the key, else the first column which is not the rowid alias (carved as 0)
+        bound.message = names.index(self.message_name) if self.message_name in names else None
+        if self.key_name in names: bound.key = names.index(self.key_name)
+        elif bound.message is not None: bound.key = bound.message
+        else: bound.key = next((col[0] for col in bound.columns if col[0] != bound.rowid), 0)
+        bound.header = self.header or names
+
+        bound.compiled = {}
+        return bound
+
+
+    def compile(self, nostrict, skip=0):
+        '''Returns the SerialValidator of the table for the given mode, compiling it the first time; with skip, the one of
+        the columns from skip on'''
+
+        if (nostrict, skip) not in self.compiled:
+            if skip: self.compiled[(nostrict, skip)] = self.compile(nostrict).tail(skip)
+            else: self.compiled[(nostrict, skip)] = SerialValidator(self.columns, nostrict, self.rowid, self.message)
+        return self.compiled[(nostrict, skip)]
+
+
+#built-in profiles for the tables of the common WeChat databases
+BUILTIN_PROFILES = [
+    #FTS index databases: the text of the messages, whose content column has no declared type
+    SchemaProfile('FTS5IndexMessage_content', types={'c0': 'TEXT'}, message='c0', header=['id', 'message'], outputs=('msg', 'deleted')),
+    #EnMicroMsg.db: chat messages, whose content must decode to a message, identified by their server id
+    SchemaProfile('message', message='content', key='msgSvrId'),
+    #EnMicroMsg.db: contacts, identified by their user name
+    SchemaProfile('rcontact', key='username'),
+]
+
+
+class SchemaRegistry:
+    '''Profiles of the tables to carve by table name: the built-in ones plus user-supplied ones'''
+
+    def __init__(self, profiles=BUILTIN_PROFILES):
+        self.profiles = {}
+        for profile in profiles: self.register(profile)
+
+
+    def register(self, profile):
+        self.profiles[profile.table] = profile
+
+
+    def load(self, path):
+        '''Registers the profiles of a JSON file: a list of objects with the arguments of SchemaProfile'''
+        with open(path, encoding='utf8') as f:
+            for entry in json.load(f):
+                self.register(SchemaProfile(**entry))
+
+
+    def resolve(self, tables, selected=None):
+        '''Returns root number: bound profile for the selected tables, or else for all the tables with a profile (all the tables if none has one)'''
+
+        roots = dict((desc[0], root) for root, desc in tables.items())
+        if selected:
+            for name in selected:
+                if name not in roots: print('Table', name, 'not found in the database')
+            names = [name for name in selected if name in roots]
+        else:
+            names = [name for name in roots if name in self.profiles] or list(roots)
+
+        return dict((roots[name], self.profiles.get(name, SchemaProfile(name)).bind(tables[roots[name]][1])) for name in names)
 
 
 ############################################################################################################################################################
@@ -299,15 +828,45 @@ class DBSchema:
 class RecordRetriever:
     '''Retrieval of the records'''
 
-    def __init__(self, file, filepath, corr, nostrict):
+    def __init__(self, file, filepath, corr, nostrict, buf=None, dbs=None, pages=None, scripts=DEFAULT_SCRIPTS, exhaustive=False):
         self.file = file
+
+        #the scan engine reads everything by index from an in-memory view of the file
+        if buf is None: buf = open_buffer(file)
+        self.buf = buf
+        self.view = memoryview(buf)
         
         #options
         self.corr = corr
         self.nostrict = nostrict
+        #messages must hold a character of one of these script classes
+        self.scripts = scripts
+        self.accept_message = message_filter(scripts)
+        #after a row is found, the scan goes on past its record, or from the next byte in exhaustive mode
+        self.exhaustive = exhaustive
+        #root number: how to read the corrupted rows of the table
+        self.corrupted_plans = {}
+
+        #pre-filter candidate offsets with numpy when it is available
+        self.prefilter = np is not None
+        self.first_byte_patterns = {}
 
         self.vr = VarintReader(file)
-        self.dbs = DBSchema(filepath)
+        self.br = BufferVarintReader(buf)
+        self.dbs = dbs if dbs is not None else DBSchema(filepath)
+
+        #page geometry, for the records whose payload spills to overflow pages; the overflow pages are read from
+        #the database given as pages when buf only holds page images (e.g. from the WAL file)
+        self.pages = buf if pages is None else pages
+        self.pages_view = self.view if pages is None else memoryview(pages)
+        self.pagesize = 0
+        if len(self.pages) >= 100:
+            self.pagesize = struct.unpack('>H', self.pages[16:18])[0]
+            if self.pagesize == 1: self.pagesize = 65536
+        self.usable = self.pagesize - self.pages[20] if self.pagesize else 0
+        #page number: (next page number, content) of the overflow pages read so far
+        self.overflow_cache = {}
+        self.freelist = None
 
     def pl_decode_id(self, serial):
         '''Returns a piece of data read from the file basing on a given serial type'''
@@ -351,119 +910,237 @@ class RecordRetriever:
             strsize = int((serial-13)/2)
             #print("hint some msg")
 
-            try:
-                tmp = self.file.read(strsize)
-                tmp = tmp.decode(encoding = "utf-8")
-                flag = zhPattern.match(tmp)
-                if flag:
-                    print("hit the msg:")
-                    print(tmp)
-                    return tmp
-            except Exception as ex:
-                tmp=None
-                #print("decode error:",ex)
-            return None
+            return self.pl_decode_msg_at(serial, 0, memoryview(self.file.read(strsize)))
         else:
             return None
 
 
+    def pl_decode_at(self, serial, offset, view=None):
+        '''Returns a piece of data read from the buffer (or the given view) at the given offset basing on a given serial type, and the offset right after it'''
+
+        if view is None: view = self.view
+        #fixed-size serials: signed integers and float
+        if serial in SERIAL_SIZES:
+            size = SERIAL_SIZES[serial]
+            if offset+size > len(view): raise IndexError('payload out of buffer')
+            if serial == 7: return struct.unpack('>d', view[offset:offset+size])[0], offset+size
+            return int.from_bytes(view[offset:offset+size], 'big', signed=True), offset+size
+
+        #serials 0, 8, 9: no payload
+        elif serial in (0, 8, 9): return self.pl_decode_id(serial), offset
+
+        #serial N>=12: blob (even) or string (odd) of size (N-12)/2 or (N-13)/2, returned as bytes
+        elif serial >= 12:
+            size = (serial-12)//2
+            if offset+size > len(view): raise IndexError('payload out of buffer')
+            return bytes(view[offset:offset+size]), offset+size
+
+        #serials 10 and 11 are reserved
+        else: raise ValueError('invalid serial type %d' % serial)
+
+
+    def pl_decode_msg_at(self, serial, offset, view=None):
+        '''Same as pl_decode_msg, reading the string straight from the buffer (or the given view) at the given offset'''
+
+        if view is None: view = self.view
+        #serial N>=13 and odd: size (N-13)/2, type str
+        if serial >=13 and serial%2:
+            strsize = (serial-13)//2
+            if offset+strsize > len(view): return None
+
+            #the filter checks the text up to its first character of the script classes, the rest is decoded only if it accepts;
+            #invalid bytes are decoded as U+FFFD, and rejected unless the bytes hold as many of it
+            data = view[offset:offset+strsize]
+            if not self.accept_message(data): return None
+            tmp = str(data, encoding = "utf-8", errors = "replace")
+            if u'\ufffd' in tmp and tmp.count(u'\ufffd') != bytes(data).count(REPLACEMENT_CHAR): return None
+            print("hit the msg:")
+            print(tmp)
+            return tmp
+        return None
+
+
+    def first_serial_offsets(self, offset, end_offset, validator):
+        '''Yields the offsets between offset and end_offset whose byte can start the first serial of a row'''
+
+        #the possible first bytes are matched with a precompiled character class
+        pattern = self.first_byte_patterns.get(id(validator))
+        if pattern is None:
+            allowed = validator.first_bytes()
+            pattern = re.compile(b'[' + b''.join(re.escape(bytes([b])) for b in allowed) + b']' if allowed else b'(?!)')
+            self.first_byte_patterns[id(validator)] = pattern
+        for match in pattern.finditer(self.buf, offset, end_offset+1):
+            yield match.start()
+
+
+    def candidate_offsets(self, offset, end_offset, validator):
+        '''Returns the offsets between offset and end_offset whose first two serials are valid, computed in one vectorized pass'''
+
+        #Varints longer than 3 bytes are rejected by the decoder anyway, so 6 bytes after each offset are enough.
+        count = min(end_offset+1, len(self.buf)) - offset
+        if count <= 0: return []
+        page = np.frombuffer(self.buf, dtype=np.uint8, count=min(count+6, len(self.buf)-offset), offset=offset)
+        #past the end of the buffer, pad with continuation bytes so that no varint can be completed
+        b = np.full(count+6, 0x80, dtype=np.int64)
+        b[:len(page)] = page
+
+        serial, length, ok = vector_varints(b, np.arange(count))
+        ok &= validator.vector_allowed(0, serial)
+        if len(validator.columns) > 1:
+            serial, length, ok1 = vector_varints(b, np.arange(count)+length)
+            ok &= ok1 & validator.vector_allowed(1, serial)
+        return (np.flatnonzero(ok)+offset).tolist()
+
+
+    def local_payload_size(self, size):
+        '''Returns the number of bytes of a table b-tree record of the given payload size which are stored in its page'''
+
+        #as in the SQLite file format: the whole payload if it fits, else between a minimum and a maximum,
+        #so that the rest fills whole overflow pages
+        usable = self.usable
+        max_local = usable-35
+        if size <= max_local: return size
+        min_local = (usable-12)*32//255-23
+        local = min_local + (size-min_local) % (usable-4)
+        return local if local <= max_local else min_local
+
+
+    def overflow_page(self, pageno):
+        '''Returns the number of the next page and the content of an overflow page, read once and then kept in the page cache'''
+
+        page = self.overflow_cache.get(pageno)
+        if page is None:
+            if len(self.overflow_cache) >= OVERFLOW_CACHE_PAGES: self.overflow_cache.clear()
+            start = (pageno-1)*self.pagesize
+            page = (int.from_bytes(self.pages[start:start+4], 'big'), bytes(self.pages_view[start+4:start+self.usable]))
+            self.overflow_cache[pageno] = page
+        return page
+
+
+    def overflow_payload(self, start, size):
+        '''Returns the payload of the given size of a record starting at the given offset, reassembled from its page and
+        its chain of overflow pages, or None if the chain is broken'''
+
+        local = self.local_payload_size(size)
+        #the number of the first overflow page follows the local bytes, which must end in the same page
+        page_end = start - start % self.pagesize + self.usable
+        if start+local+4 > page_end: return None
+        pieces = [self.view[start:start+local]]
+        remaining = size-local
+        pageno = int.from_bytes(self.buf[start+local:start+local+4], 'big')
+
+        #Overflow pages of deleted records go to the freelist: as leaf pages they are left untouched,
+        #so their chain can be followed; a trunk page has its first bytes overwritten by the freelist.
+        if self.freelist is None: self.freelist = FreeSpaceMap(self.pages, self.pagesize)
+        page_count = len(self.pages)//self.pagesize
+        seen = set()
+        while remaining > 0:
+            if not 1 < pageno <= page_count or pageno in seen or pageno in self.freelist.trunks: return None
+            seen.add(pageno)
+            pageno, content = self.overflow_page(pageno)
+            pieces.append(content[:remaining])
+            remaining -= len(content)
+        return b''.join(pieces)
+
+
+    def read_row(self, profile, serials, offset, pos):
+        '''Returns the row whose serials start at offset and end at pos, or None if it is not valid, and the offset right
+        after the record in its page; when its payload spills to overflow pages, the row is read from the payload
+        reassembled from them'''
+
+        #the record header starts with its own size, a varint of 1 or 2 bytes before the serials
+        header = pos-offset+1
+        if header > 127: header += 1
+        body = sum(SERIAL_SIZES.get(serial, (serial-12)//2 if serial >= 12 else 0) for serial in serials)
+        size = header+body
+        if not self.pagesize or size <= self.usable-35: return self.decode_row(profile, serials, pos), pos+body
+
+        #the page holds the first bytes of the payload and the number of the first overflow page
+        start = offset-(1 if header <= 127 else 2)
+        end = start+self.local_payload_size(size)+4
+        payload = self.overflow_payload(start, size)
+        if payload is None: return None, end
+        return self.decode_row(profile, serials, pos-start, memoryview(payload)), end
+
+
+    def decode_row(self, profile, serials, pos, view=None, first=0):
+        '''Returns the row stored at the given offset (of the buffer or of the given view) with the given serials, or None if it is not valid;
+        the serials are the ones of the columns from first on, the columns before are lost and returned as null'''
+
+        row = [None]*first
+        for cid, serial in enumerate(serials, first):
+            if cid == profile.message:
+                value = self.pl_decode_msg_at(serial, pos, view)
+                if value is None: return None
+                pos += (serial-13)//2
+            else:
+                try:
+                    value, pos = self.pl_decode_at(serial, pos, view)
+                    if serial >= 13 and serial%2: value = value.decode('utf-8')
+                except (IndexError, ValueError, struct.error):
+                    return None
+            row.append(value)
+
+        #the rowid is not part of the record
+        if profile.rowid is not None: row[profile.rowid] = 0
+        return list(self.compatible_strings(row))
+
 
     def intact_rows_bruteforce(self, offset, end_offset, table_rootno):
         '''Retrieval of rows with intact headers'''
 
         #This function attempts a retrieval of intact rows adopting a brute-force strategy
         #in order to avoid the false negatives of corrupted and truncated rows.
-        #Starting from given offset, it reads possible serial numbers according to the given table schema;
+        #Starting from given offset, it reads possible serial numbers according to the profile of the table;
         #if these appear to be valid serial number, it proceeds to extract data,
         #which is further verified; the process loops by moving offset of one byte
-        #until the indicated end offset is met.
+        #until the indicated end offset is met. Once a row is found with its key column, the offsets inside its
+        #record are skipped, unless in exhaustive mode, for records overlapping others.
         
         got = []
         found = {}
-        #table description and number of columns
-        table_desc = self.dbs.tables[table_rootno][1]
-        #column_no = len(table_desc)
-        offset = offset + 10
-        while offset <= end_offset:
+        #profile of the table and serials accepted by each column
+        profile = self.dbs.profiles[table_rootno]
+        validator = profile.compile(self.nostrict)
+        columns = validator.columns
+        varint = self.br.varint_integer
+
+        #only visit the offsets whose first byte can start a row, or the ones surviving the vectorized pre-filter
+        if self.prefilter: candidates = self.candidate_offsets(offset, end_offset, validator)
+        else: candidates = self.first_serial_offsets(offset, end_offset, validator)
+
+        skip_to = offset
+        for offset in candidates:
+            if offset < skip_to: continue
             #global_count =  global_count+1
-            self.file.seek(offset)
-            #print('At offset', offset)
-
-            # try:
-            #     pl_len, rowid, hd_len = self.vr.n_varints_file(3)
-            # except:
-            #     offset += 1
-            #     continue
 
-            #read as many varints as the number of columns
-            serials = [0,0]
+            #read and validate as many serials as the number of columns
+            serials = []
+            pos = offset
             try:
-                type1 = self.vr.varint_integer()
-                if type1 != 0:
-                    offset += 1
-                    continue
-                    return
-                type2 = self.vr.varint_integer()
-                if type2 == None:
-                    offset += 1
-                    continue
-                    return
-                serials[0] = type1
-                serials[1] = type2
-            except struct.error:
-                offset += 1
-                continue
-
-            #validate them
-            gen = self.dbs.validate_serials(serials, table_desc, 0, self.nostrict)
-            #if invalid, advance and restart
-            if  gen == False:
-                offset += 1
-                continue
-            if gen[0]>1000000 or gen[1]==0 or gen[1]>1000000 :
-                offset += 1
-                continue
-            if self.file.tell() >= end_offset: break
-
-            else:
-                try:
-                    #extract a row according to the found serials
-                    #print(serials)
-                    row=[None,None]
-                    row[0]=0
-                    row[1]=self.pl_decode_msg(serials[1])
-                    if row[1] is None:
-                        offset += 1
-                        continue
-                    #tt=global_data_sets
-                    #row[1] = row[1].strip()
-                    global_data_sets.append(row)
-                    #bbytes = row[1].encode('utf8')
-                    #b_length = len(bbytes)
-                    #offset = offset+b_length
-                    #continue
-                except Exception as ex:
-                    print(ex)
-                    offset += 1
-                    continue
-
-                #if the row is not empty and its data is valid, append it to the list of results                
-                # if any(row) and all([self.dbs.data_check(piece) for piece in row]):
-                #     #append to found the start and end of this row
-                #     found[offset] = self.file.tell()
-                # if all([self.compatible_strings(row)[1:] != vis[1:] for vis in self.dbs.cells[table_rootno]]):
-                #     if row[0] == None: row[0] = rowid
-                #     row = self.compatible_strings(row)
-                #     got.append(row)
-                #
-                #     offset = self.file.tell()+1
-                #     continue
-
-                #make a cursor check
-                #if self.file.tell()>=end_offset: break
-
-            #move on
-            offset+=1
+                for mask, nullable, text, blob in columns:
+                    serial, pos = varint(pos)
+                    if serial is None: break
+                    #lookup in the bitmap, or parity and size check for strings and blobs
+                    if serial < 12:
+                        if not mask >> serial & 1: break
+                    elif serial > MAX_SERIAL or not (text if serial & 1 else blob): break
+                    serials.append(serial)
+            except IndexError:
+                break
+            #if invalid, or if every column is null (e.g. in zeroed space), advance and restart
+            if len(serials) < len(columns) or not any(serials): continue
+            if pos >= end_offset: break
+
+            #extract a row according to the found serials; a long one is read from its overflow pages
+            row, end = self.read_row(profile, serials, offset, pos)
+            if row is not None:
+                got.append(row)
+                #offset of the first serial: offset of the last byte of the record
+                found[offset] = end-1
+                #a row is confirmed by the column which identifies it, the message by default: rows of nulls
+                #are too weak to hide the records they overlap
+                if not self.exhaustive and row[profile.key] is not None: skip_to = end
             
         #the dictionary found is used later in the retrieval of corrupted rows        
         return (got, found)
@@ -473,80 +1150,143 @@ class RecordRetriever:
         '''Partial retrieval of rows with corrupted headers'''
 
         #This function adopts an algorithm similar those of function intact_rows_bruteforce;
-        #however, corrupted rows have corrupted primary key serials. Therefore, only non-primary key
-        #serial numbers are read and validated. 
-        #In each row, primary keys occupy a space of up to 8*pk_no bytes;
-        #once the function has read non-pk serials, it tries to read the row starting at different offsets
-        #so that it skips each possible number of bytes occupied by primary keys.
-        #As a result, groups of possible rows are found instead of single rows 
+        #however, corrupted rows have corrupted primary key serials: when a cell is freed, its first 4 bytes are
+        #overwritten, and with them the first serials of a short record. Therefore, only the serials of the other
+        #columns are read and validated, from the candidate offsets of these columns.
+        #The values of the lost columns come first in the body, so the row is read after each of their possible
+        #sizes, up to CORRUPTED_FANOUT of them; the readings are scored and only the best one is kept.
+        #The records already recovered by the intact pass, in the dictionary found, are skipped, and a record is only read
+        #where a freeblock header may have overwritten its first bytes, and within the size of that freeblock.
 
         got = []
-        #get table description, number of columns, number of primary keys
-        table_desc = self.dbs.tables[table_rootno][1]
-        column_no = len(table_desc)
-        pk_no = len([column_desc for column_desc in table_desc if column_desc[5]])
-
-        while offset <= end_offset:
-            self.file.seek(offset)
-
-            #if the cursor's at the beginning of a row that's already been found intact,
-            #skip it and jump right after its end
-            if offset in found:
-                offset = found[offset] + 1
+        plan = self.corrupted_plan(table_rootno)
+        if plan is None: return got
+        profile, skip, validator, shifts = plan
+        columns = validator.columns
+        varint = self.br.varint_integer
+
+        #(first offset, last offset) of the intact records, in order
+        recovered = sorted(found.items())
+        r = 0
+
+        if self.prefilter: candidates = self.candidate_offsets(offset, end_offset, validator)
+        else: candidates = self.first_serial_offsets(offset, end_offset, validator)
+
+        skip_to = offset
+        for offset in candidates:
+            if offset < skip_to: continue
+            #skip the records of the intact rows
+            while r < len(recovered) and recovered[r][1] < offset: r += 1
+            if r < len(recovered) and recovered[r][0] <= offset:
+                skip_to = recovered[r][1]+1
                 continue
 
+            #read and validate the serials of the columns which are not lost
+            serials = []
+            pos = offset
             try:
-                #read as many possible serial numbers as the number of columns which are not primary keys
-                serials = self.vr.n_varints_file(column_no - pk_no)
+                for mask, nullable, text, blob in columns:
+                    serial, pos = varint(pos)
+                    if serial is None: break
+                    if serial < 12:
+                        if not mask >> serial & 1: break
+                    elif serial > MAX_SERIAL or not (text if serial & 1 else blob): break
+                    serials.append(serial)
+            except IndexError:
+                break
+            if len(serials) < len(columns) or not any(serials): continue
+            if pos >= end_offset: break
+            limit = min(end_offset, self.freeblock_end(offset, skip))
+            if not limit: continue
+
+            #read the row after each possible size of the lost values, within the freeblock, and keep the best reading
+            body = sum(SERIAL_SIZES.get(serial, (serial-12)//2 if serial >= 12 else 0) for serial in serials)
+            best, best_score = None, 0
+            for shift in shifts:
+                if pos+shift+body > limit: break
+                row = self.decode_row(profile, serials, pos+shift, first=skip)
+                if row is None: continue
+                score = self.row_score(row, skip)
+                if score > best_score: best, best_score, best_end = row, score, pos+shift+body
+
+            if best is not None:
+                got.append(best)
+                if not self.exhaustive: skip_to = best_end
 
-            except struct.error:
-                offset += 1
-                continue
-            if self.file.tell() >= end_offset: break
+        return got
 
-            #validate them; advance and restart if not valid
-            gen = self.dbs.validate_serials(serials, table_desc, pk_no, self.nostrict)
-            if not gen:
-                offset += 1
-                continue
 
-            else:
-                group = []
-                bku = self.file.tell()
-                
-                for i in range(8*pk_no):
-                    #this allows all possible numbers of bytes occupied by primary keys
-                    self.file.seek(bku + i)
-                    #read row, append to group if valid
-                    try:
-                        row = [self.pl_decode_file(code) for code in gen]
-                    except:
-                        continue
-                                              
-                    if any(row) and all([self.dbs.data_check(piece) for piece in row]):
-                        row = self.compatible_strings(row)
-                        group.append(row)
-
-                if any(group):
-                    got.append(group)
+    def corrupted_plan(self, table_rootno):
+        '''Returns the profile of a table, the number of its first columns whose serials are lost in a corrupted row, the validator
+        of the other columns and the possible sizes of the lost values; None if the key column of the table would be lost'''
+
+        if table_rootno not in self.corrupted_plans:
+            profile = self.dbs.profiles[table_rootno]
+            #the primary key columns come first in the tables of the WeChat databases, at least one column is lost
+            skip = max(1, len([column for column in profile.columns if column[5]]))
+            #without its key, a row could not be told from a live one
+            plan = None
+            if profile.key >= skip:
+                sizes = set([0])
+                for mask, nullable, text, blob in profile.compile(self.nostrict).columns[:skip]:
+                    #a column stored as null (e.g. the rowid alias) takes no byte; strings and blobs are tried up to the fanout
+                    column = set(SERIAL_SIZES.get(serial, 0) for serial in range(10) if mask >> serial & 1)
+                    if text or blob: column.update(range(CORRUPTED_FANOUT))
+                    sizes = set(a+b for a in sizes for b in column)
+                plan = (profile, skip, profile.compile(self.nostrict, skip), sorted(sizes)[:CORRUPTED_FANOUT])
+            self.corrupted_plans[table_rootno] = plan
+        return self.corrupted_plans[table_rootno]
+
+
+    def freeblock_end(self, offset, skip):
+        '''Returns the farthest end of the freeblocks whose header may have overwritten the first 4 bytes of a cell, right before
+        the serials of its columns from skip on at offset; 0 if there is none'''
+
+        #the lost bytes are the ones of the payload size, the rowid, the header size and the first serials of the cell;
+        #a freeblock header is the offset of the next freeblock in the page, 0 for the last one, and the size of the block
+        page = offset - offset % self.pagesize
+        end = 0
+        for start in range(max(page+8, offset-4-2*skip), offset-3):
+            following = self.buf[start] << 8 | self.buf[start+1]
+            size = self.buf[start+2] << 8 | self.buf[start+3]
+            if size < 4 or start+size > page+self.usable: continue
+            if following and not start+size <= page+following < page+self.usable: continue
+            end = max(end, start+size)
+        return end
+
+
+    def row_score(self, row, first):
+        '''Scores a reading of a corrupted row: printable strings count most, then the other values which are not null'''
+        score = 0
+        for value in row[first:]:
+            if isinstance(value, str): score += 2 if value and value.isprintable() else -1
+            elif value is not None: score += 1
+        return score
 
-            #move on
-            offset +=1
-        
-        return got
 
-        
     def scan_page(self, offset, end_offset, table_rootno):
         '''Retrieval of rows in a page depending on specified options'''
 
-        #retrieve intact rows
-        introws, found = self.intact_rows_bruteforce(offset, end_offset, table_rootno)
-        #if specified by options, attempt retrieval of corrupted rows as well
-        # if self.corr: corrows = self.corrupted_rows_bruteforce(offset, end_offset, table_rootno, found)
-        # #otherwise return an empty list instead
-        # else: corrows=[]
-        
-        return (introws, None)
+        #retrieve intact rows, skipping the page header
+        return self.scan_regions([(offset+10, end_offset)], table_rootno)
+
+
+    def scan_regions(self, regions, table_rootno):
+        '''Retrieval of rows in a list of (start offset, end offset) regions of the file; returns (intact rows, corrupted rows)'''
+
+        introws = []
+        corrows = []
+        for offset, end_offset in regions:
+            got, found = self.intact_rows_bruteforce(offset, end_offset, table_rootno)
+            introws.extend(got)
+            #if specified by options, attempt retrieval of corrupted rows as well, around the intact ones
+            if self.corr: corrows.extend(self.corrupted_rows_bruteforce(offset, end_offset, table_rootno, found))
+        return (introws, corrows)
+
+
+    def scan_tables(self, regions, roots):
+        '''Retrieval of the rows of each of the given tables in a list of regions; returns a list of (root number, intact rows, corrupted rows)'''
+        return [(rootno,) + self.scan_regions(regions, rootno) for rootno in roots]
 
 
     def compatible_strings(self, iterable):
@@ -561,10 +1301,229 @@ class RecordRetriever:
 ################################################################################################################################################
 
 
+class FreeSpaceMap:
+    '''Free regions of the database pages, found from the file header, the freelist and the b-tree page headers'''
+
+    def __init__(self, buf, pagesize):
+        self.buf = buf
+        self.pagesize = pagesize
+        #the last bytes of each page are reserved (e.g. by encryption extensions)
+        self.usable = pagesize - buf[20]
+        self.page_count = len(buf)//pagesize
+        #trunk page number: number of leaf page numbers it holds
+        self.trunks = {}
+        self.leaves = set()
+        self.read_freelist()
+
+
+    def u16(self, offset):
+        return (self.buf[offset] << 8) | self.buf[offset+1]
+
+
+    def u32(self, offset):
+        return int.from_bytes(self.buf[offset:offset+4], 'big')
+
+
+    def read_freelist(self):
+        '''Follows the chain of freelist trunk pages, starting from the one in the file header'''
+
+        #Each trunk page holds the number of the next trunk page, the number of leaf pages
+        #it lists and the leaf page numbers; leaf pages hold no information at all.
+        trunk = self.u32(32)
+        while 1 < trunk <= self.page_count and trunk not in self.trunks:
+            offset = (trunk-1)*self.pagesize
+            count = min(self.u32(offset+4), (self.usable-8)//4)
+            self.trunks[trunk] = count
+            for i in range(count):
+                leaf = self.u32(offset+8+4*i)
+                if 1 < leaf <= self.page_count: self.leaves.add(leaf)
+            trunk = self.u32(offset)
+
+
+    def page_header(self, pageno):
+        '''Returns the offset of the b-tree page header and the page type flag'''
+        header = (pageno-1)*self.pagesize + (100 if pageno == 1 else 0)
+        return header, self.buf[header]
+
+
+    def page_regions(self, pageno):
+        '''Returns the free (start offset, end offset) regions of a page'''
+
+        start = (pageno-1)*self.pagesize
+
+        #freelist pages are entirely free, apart from the page numbers held by trunk pages
+        if pageno in self.leaves: return [(start, start+self.usable)]
+        if pageno in self.trunks: return [(start+8+4*self.trunks[pageno], start+self.usable)]
+
+        #only table b-tree pages (interior 5, leaf 13) hold table records; index, overflow and other pages are skipped
+        header, flag = self.page_header(pageno)
+        if flag not in (5, 13): return []
+        header_size = 12 if flag == 5 else 8
+        cell_no = self.u16(header+3)
+        content = self.u16(header+5) or 65536
+
+        regions = []
+        #the unallocated space between the cell pointer array and the cell content area
+        gap = header + header_size + 2*cell_no
+        if start+content > gap: regions.append((gap, min(start+content, start+self.usable)))
+
+        #the chain of freeblocks: 2 bytes offset of the next freeblock, 2 bytes size of this one
+        freeblock = self.u16(header+1)
+        seen = set()
+        while freeblock and freeblock not in seen and freeblock+4 <= self.usable:
+            seen.add(freeblock)
+            size = self.u16(start+freeblock+2)
+            regions.append((start+freeblock, start+min(freeblock+size, self.usable)))
+            freeblock = self.u16(start+freeblock)
+
+        return sorted(regions)
+
+
+    def btree_pages(self, rootno):
+        '''Returns the numbers of the pages of the table b-tree starting at the given root'''
+
+        pages = []
+        stack = [rootno]
+        while stack:
+            pageno = stack.pop()
+            if not 0 < pageno <= self.page_count or pageno in pages: continue
+            pages.append(pageno)
+            header, flag = self.page_header(pageno)
+            #interior pages: each cell starts with the 4-byte number of a child page, the right-most child is in the header
+            if flag == 5:
+                start = (pageno-1)*self.pagesize
+                stack.append(self.u32(header+8))
+                for i in range(self.u16(header+3)):
+                    stack.append(self.u32(start+self.u16(header+12+2*i)))
+        return sorted(pages)
+
+
+class PageHistory:
+    '''Older images of the database pages, found in the frames of its write-ahead log and the records of its rollback journal'''
+
+    def __init__(self, pagesize, decrypt=None):
+        self.pagesize = pagesize
+        #decrypts a page image given its page number, for the WAL file and journal of an encrypted database
+        self.decrypt = decrypt
+        #page images in the order they are found: (page number, version, source, state, image)
+        self.images = []
+        #page number: number of images of the page
+        self.versions = defaultdict(int)
+        self.digests = set()
+        #page number: newest committed image in the WAL file, and size of the database in pages after the last commit
+        self.committed = {}
+        self.dbsize = 0
+
+
+    def add(self, pageno, source, state, image):
+        '''Indexes a page image by page number and version, unless the same image has already been found; returns the image'''
+        if self.decrypt is not None: image = self.decrypt(pageno, image)
+        return self.index(pageno, source, state, image)
+
+
+    def index(self, pageno, source, state, image):
+        '''Indexes a plain page image, unless the same image has already been found; returns the image'''
+        digest = hashlib.blake2b(image, digest_size=16).digest()
+        if digest not in self.digests:
+            self.digests.add(digest)
+            self.versions[pageno] += 1
+            self.images.append((pageno, self.versions[pageno], source, state, image))
+        return image
+
+
+    def read_wal(self, path):
+        '''Indexes the frames of a write-ahead log; returns the number of frames read'''
+
+        #Each frame is a 24-byte header (page number, size of the database after a commit or 0, salts, checksums)
+        #and a page image. Frames carry the salts of the header until the log is restarted: frames with other
+        #salts are left from before, and the frames after the last commit of the log were never committed.
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < WAL_HEADER_SIZE: return 0
+        magic, version, pagesize, seq, salt1, salt2 = struct.unpack('>6I', data[:24])
+        if magic not in WAL_MAGIC or pagesize != self.pagesize:
+            print('%s is not a write-ahead log of this database, skipping it' % path)
+            return 0
+
+        frame_size = WAL_FRAME_HEADER_SIZE + pagesize
+        frames = []
+        for offset in range(WAL_HEADER_SIZE, len(data) - frame_size + 1, frame_size):
+            pageno, commit, frame_salt1, frame_salt2 = struct.unpack('>4I', data[offset:offset+16])
+            if pageno: frames.append((offset, pageno, commit, (frame_salt1, frame_salt2) == (salt1, salt2)))
+        last_commit = max([i for i, frame in enumerate(frames) if frame[2] and frame[3]] or [-1])
+
+        for i, (offset, pageno, commit, current) in enumerate(frames):
+            state = 'committed' if current and i <= last_commit else ('uncommitted' if current else 'stale')
+            image = self.add(pageno, 'wal frame %d' % (i+1), state, data[offset+WAL_FRAME_HEADER_SIZE:offset+frame_size])
+            #the frames are in the order they were written: the last committed one of a page is its current image
+            if state == 'committed':
+                self.committed[pageno] = image
+                if commit: self.dbsize = commit
+        return len(frames)
+
+
+    def checkpoint(self, image):
+        '''Returns the image of the database with the committed pages of the WAL file written into it, as a checkpoint would;
+        the pages they replace are kept as older images'''
+        if not self.committed: return image
+        size = self.dbsize*self.pagesize
+        if size > len(image): image = bytearray(image) + bytearray(size-len(image))
+        for pageno, page in self.committed.items():
+            if pageno*self.pagesize <= len(image):
+                replaced = bytes(image[(pageno-1)*self.pagesize:pageno*self.pagesize])
+                if replaced != page and any(replaced): self.index(pageno, 'database', 'checkpointed', replaced)
+                image[(pageno-1)*self.pagesize:pageno*self.pagesize] = page
+        return image
+
+
+    def read_journal(self, path):
+        '''Indexes the records of a rollback journal; returns the number of records read'''
+
+        #The journal holds the images of the pages before the transaction changed them, as records of a 4-byte page number,
+        #the page image and a checksum, after a header padded to the sector size; a journal can hold several segments.
+        #A persisted journal has its header zeroed: its records are read up to the next header or the end of the file.
+        with open(path, 'rb') as f:
+            data = f.read()
+        record_size = 4 + self.pagesize + 4
+        count = 0
+        offset = 0
+        while offset + JOURNAL_SECTOR_SIZE < len(data):
+            if data[offset:offset+8] == JOURNAL_MAGIC:
+                records, nonce, dbsize, sector, pagesize = struct.unpack('>5I', data[offset+8:offset+28])
+                if pagesize != self.pagesize:
+                    print('%s is not a journal of this database, skipping it' % path)
+                    return count
+                #0 or 0xffffffff: the number of records was not written, they run to the next header
+                if records in (0, 0xffffffff): records = None
+                state = 'journal'
+            elif not any(data[offset:offset+28]):
+                records, sector = None, JOURNAL_SECTOR_SIZE
+                state = 'persisted journal'
+            else:
+                break
+            sector = sector or JOURNAL_SECTOR_SIZE
+            offset += sector
+
+            read = 0
+            while offset + record_size <= len(data) and (read < records if records is not None else data[offset:offset+8] != JOURNAL_MAGIC):
+                pageno = struct.unpack('>I', data[offset:offset+4])[0]
+                if pageno:
+                    count += 1
+                    self.add(pageno, 'journal record %d' % count, state, data[offset+4:offset+4+self.pagesize])
+                offset += record_size
+                read += 1
+            #the next segment starts on a sector boundary
+            offset = -(-offset // sector) * sector
+        return count
+
+
+################################################################################################################################################
+
+
 class DBScanner:
     '''High-level retrieving of deleted data and outputting'''
     
-    def __init__(self, filepath, out, corr, nostrict, tab, raw, verbose):
+    def __init__(self, filepath, out, corr, nostrict, tab, raw, verbose, use_mmap=True, jobs=1, writer=None, freespace=False, registry=None, tables=None, buf=None, scripts=DEFAULT_SCRIPTS, exhaustive=False):
         
         self.start = time.time()
         print('SQLiteRet', time.strftime('%d-%m-%Y %H:%M:%S', time.gmtime(self.start)))
@@ -579,15 +1538,21 @@ class DBScanner:
                 exit(0)
             
     
-        #init file and file info
+        #init file and file info; a database already in memory (e.g. decrypted) is scanned from its buffer
         self.filepath = filepath
-        try:
-            self.file = open(self.filepath, 'rb')
-        except Exception as ex:
-            print(ex)
-            print('Database file not found or you don\'t have permission to access file.\nExiting program.')
-            exit(0)
-        self.filesize = len(self.file.read())
+        self.image = buf
+        if buf is not None:
+            self.file = None
+            self.buf = buf
+        else:
+            try:
+                self.file = open(self.filepath, 'rb')
+            except Exception as ex:
+                print(ex)
+                print('Database file not found or you don\'t have permission to access file.\nExiting program.')
+                exit(0)
+            self.buf = open_buffer(self.file, use_mmap)
+        self.filesize = len(self.buf)
         self.pagesize = self.find_pagesize()
 
         #init options
@@ -595,6 +1560,15 @@ class DBScanner:
         self.tab = tab
         self.raw = raw
         self.verbose = verbose
+        self.nostrict = nostrict
+        self.use_mmap = use_mmap
+        self.jobs = jobs
+        #scan only the free space of the b-tree and freelist pages
+        self.freespace = FreeSpaceMap(self.buf, self.pagesize) if freespace else None
+        #recovered rows are streamed to the writer as the pages are scanned
+        self.writer = writer
+        #hashes of the rows handed over to the writer, when the rows of the page images of the WAL file and journal are carved after
+        self.seen = None
 
         #set up for retrieval        
         self.introws = defaultdict(list)
@@ -602,7 +1576,7 @@ class DBScanner:
         self.done = []
         self.rst = sys.stdout
         self.nullwriter = NullWriter()
-        self.rrt = RecordRetriever(self.file, filepath, corr, nostrict)
+        self.rrt = RecordRetriever(self.file, filepath, corr, nostrict, self.buf, DBSchema(filepath, registry=registry, selected=tables, image=buf), scripts=scripts, exhaustive=exhaustive)
 
 
     def execute(self):
@@ -677,9 +1651,7 @@ class DBScanner:
                     print()
 
                     try:
-                        for t in self.corrows[i]:
-                            for i in t: print(i)
-                            print()
+                        for t in self.corrows[i]: print(t)
                     except MemoryError:
                         continue
 
@@ -724,11 +1696,8 @@ class DBScanner:
                     print('\n')
 
                     try:
-                        for t in self.corrows[i]:                           
-                            for i in t:
-                                for p in i: 
-                                    print(p, end='\t')                                      
-                                print()
+                        for t in self.corrows[i]:
+                            for p in t: print(p, end='\t')
                             print()
                         
                     
@@ -747,8 +1716,7 @@ class DBScanner:
     def find_pagesize(self):
         '''Returns needed information found in the database file header'''
         #database page size
-        self.file.seek(16)
-        pagesize = struct.unpack('>H', self.file.read(2))[0]
+        pagesize = struct.unpack('>H', self.buf[16:18])[0]
         if pagesize == 1: pagesize = 65536
         return pagesize
 
@@ -760,27 +1728,39 @@ class DBScanner:
         #If any number pages are found, visit each of them and retrieve rows using the schema of the root.
         
         print('Attempting retrieval from known schemas')
-        for rootno in self.rrt.dbs.tables:
+        for rootno in self.rrt.dbs.profiles:
             print('\n Scanning table', self.rrt.dbs.tables[rootno][0])
 
+            #in free space mode, walk the table b-tree and scan the free regions of its pages
+            if self.freespace:
+                others = self.freespace.btree_pages(rootno)
+                for pageno in others:
+                    introws, corrows = self.rrt.scan_regions(self.freespace.page_regions(pageno), rootno)
+                    self.emit(pageno, [(rootno, introws, corrows)])
+                    self.introws[rootno].extend(introws)
+                    self.corrows[rootno].extend(corrows)
+                    if self.corr:
+                        print('  Page {:>3}\t{:>4} intact rows found\t{:>4} corrupted rows found'.format(pageno, len(introws), len(corrows)))
+                    else:
+                        print('  Page {:>3}\t{:>4} rows found'.format(pageno, len(introws)))
+                self.done.extend(others)
+                continue
+
             #the first page of the pages to scan is of course the root
             others = [rootno]
 
             #go to start of page
             offset = (rootno-1)*self.pagesize
 
-            #start reading page
-            while offset < rootno*self.pagesize:
-                self.file.seek(offset)
-                #read first two bytes
-                zeros = struct.unpack('>BB', self.file.read(2))
-                #verify they're 0; if so, the next byte is the number of a page to scan
-                if not any(zeros):
-                    page = struct.unpack('>B', self.file.read(1))[0]
-                    #exclude page numbers 0 and 1
-                    if page and page != 1: others.append(page)
+            #start reading page: look for two 0 bytes, the next byte is the number of a page to scan
+            end = min(rootno*self.pagesize, self.filesize-2)
+            offset = self.buf.find(b'\x00\x00', offset, end+1)
+            while 0 <= offset < end:
+                page = self.buf[offset+2]
+                #exclude page numbers 0 and 1
+                if page and page != 1: others.append(page)
                 #move further on
-                offset+=1
+                offset = self.buf.find(b'\x00\x00', offset+1, end+1)
 
             #clean up the list a bit
             others = sorted(set(others))
@@ -790,6 +1770,7 @@ class DBScanner:
 	        #corrupted rows won't be looked for and an empty list will be returned instead
                 introws, corrows = self.rrt.scan_page(self.pagesize*(pageno-1), self.pagesize*pageno, rootno)
                 #append to main dictionaries intact and corrupted rows
+                self.emit(pageno, [(rootno, introws, corrows)])
                 self.introws[rootno].extend(introws)
                 self.corrows[rootno].extend(corrows)
 
@@ -826,8 +1807,7 @@ class DBScanner:
                 continue
 
             else:
-                self.file.seek(offset)
-                flag = struct.unpack('>B', self.file.read(1))[0]
+                flag = self.buf[offset]
                 #skip index pages
                 if flag in [10, 12]:
                     offset += self.pagesize
@@ -837,7 +1817,7 @@ class DBScanner:
                 #recover the rows for each schemas
                 print('\n Scanning page', pageno)
                 d = {}
-                for root in self.rrt.dbs.tables:
+                for root in self.rrt.dbs.profiles:
                     print('  Attempting schema {:<25}'.format(self.rrt.dbs.tables[root][0]), end='\t')
                     d[root] = self.rrt.scan_page(offset, offset+self.pagesize, root)
                     if self.corr:
@@ -892,41 +1872,134 @@ class DBScanner:
                     #if no records have been found, there is a chance there are no more full page. 
 		    #Go backwards, read a significant number of bytes and, if they're all 0,
                     #terminate scanning.
-                    self.file.seek(self.file.tell()-100)
-                    if not any(self.file.read(100)): break
+                    if not any(self.buf[offset+self.pagesize-100:offset+self.pagesize]): break
 
                 if root:
                     introws, corrows = d[root]
                     self.introws[root].extend(introws)
                     self.corrows[root].extend(corrows)
 
+                    self.emit(pageno, [(root, introws, corrows)])
+
             offset += self.pagesize
             pageno += 1
 
     def all_table_scan(self):
         page_num = int(self.filesize/self.pagesize)
-        others = range(3,page_num)
-        # then visit each of the page numbers found
-        for pageno in others:
+        # every table with a profile is carved in the same pass
+        roots = list(self.rrt.dbs.profiles)
+        # in free space mode, every page is scanned but only in its free regions;
+        # otherwise, from page 3 on, each page is scanned past its header
+        if self.freespace:
+            work = [(pageno, self.freespace.page_regions(pageno)) for pageno in range(1, page_num+1)]
+        else:
+            work = [(pageno, [(self.pagesize * (pageno - 1) + 10, self.pagesize * pageno)]) for pageno in range(3,page_num)]
+        # skip the pages a resumed scan has already done
+        if self.writer and self.writer.checkpoint:
+            work = [(pageno, regions) for pageno, regions in work if pageno not in self.writer.checkpoint]
+        # scan the pages and find the rows of each table
+        if self.jobs > 1:
+            results = self.parallel_scan(work, roots)
+        else:
+            results = ((pageno, self.rrt.scan_tables(regions, roots)) for pageno, regions in work)
+        # then visit each of the page numbers found, in page order
+        for pageno, found in results:
             print("scaning page no is :",pageno)
-            # scan the pages and find the rows - if the user hasn't specified otherwise,
-            # corrupted rows won't be looked for and an empty list will be returned instead
-            introws, corrows = self.rrt.scan_page(self.pagesize * (pageno - 1), self.pagesize * pageno, 21)
-            # append to main dictionaries intact and corrupted rows
-            #self.introws[rootno].extend(introws)
-            #self.corrows[rootno].extend(corrows)
-
-            # give different outputs depending on the user's option for corrupted rows
-            # if self.corr:
-            #     print('  Page {:>3}\t{:>4} intact rows found\t{:>4} corrupted rows found'.format(pageno, len(introws),
-            #                                                                                      len(corrows)))
-            # else:
-            #     print('  Page {:>3}\t{:>4} rows found'.format(pageno, len(introws)))
-            # print("find delete record:")
-            # print(introws)
-
-        # remember which pages have already been scanned
-        # self.done.extend(others)
+            self.emit(pageno, found)
+
+
+    def history_scan(self, history):
+        '''Carves the older images of the pages found in the WAL file and journal, with the schema of the database'''
+
+        #The images are copied one after the other into a buffer, skipping the ones which are the same as the page
+        #in the database, and carved as pages of the database would be; the overflow pages of their rows are read
+        #from the database. The same row is often in several images of a page, or in the page of the database, and is written once.
+        #The images a resumed scan has already carved are carved again, to know their rows, but not written.
+        images = [entry for entry in history.images
+                  if self.buf[(entry[0]-1)*self.pagesize:entry[0]*self.pagesize] != entry[4]]
+        if not images: return
+        print('Carving %d page images from the WAL file and journal' % len(images))
+        buf = b''.join(entry[4] for entry in images)
+        rrt = RecordRetriever(None, self.filepath, self.corr, self.nostrict, buf, self.rrt.dbs, pages=self.buf, scripts=self.rrt.scripts, exhaustive=self.rrt.exhaustive)
+        roots = list(rrt.dbs.profiles)
+
+        done = self.writer.checkpoint.history if self.writer and self.writer.checkpoint else 0
+        if self.seen is None: self.seen = set()
+        for i, (pageno, version, source, state, image) in enumerate(images):
+            start = i*self.pagesize + (100 if pageno == 1 else 10)
+            found = []
+            for rootno, introws, corrows in rrt.scan_tables([(start, (i+1)*self.pagesize)], roots):
+                found.append((rootno, self.unseen(rootno, introws), self.unseen(rootno, corrows)))
+            if self.verbose:
+                print('  Page {:>3} version {} ({}, {})\t{:>4} rows found'.format(pageno, version, source, state, sum(len(rows)+len(partial) for rootno, rows, partial in found)))
+            if self.writer and i >= done:
+                for rootno, rows, partial in found:
+                    self.writer.add(rrt.dbs.profiles[rootno], rows)
+                    if partial: self.writer.add_corrupted(rrt.dbs.profiles[rootno], partial)
+                self.writer.history_done(i+1)
+
+
+    def emit(self, pageno, found):
+        '''Hands the rows recovered from a page, as a list of (root number, intact rows, corrupted rows), over to the writer'''
+        if self.writer:
+            for rootno, introws, corrows in found:
+                self.writer.add(self.rrt.dbs.profiles[rootno], introws)
+                if corrows: self.writer.add_corrupted(self.rrt.dbs.profiles[rootno], corrows)
+                if self.seen is not None: self.unseen(rootno, introws + corrows)
+            self.writer.page_done(pageno)
+
+
+    def unseen(self, rootno, rows):
+        '''Returns the rows of a table which have not been handed over to the writer yet, marking them as handed over'''
+        new = []
+        for row in rows:
+            digest = hashlib.blake2b(repr((rootno, tuple(row))).encode('utf8'), digest_size=8).digest()
+            if digest not in self.seen:
+                self.seen.add(digest)
+                new.append(row)
+        return new
+
+
+    def parallel_scan(self, work, roots):
+        '''Scans the given (page number, regions) in a pool of worker processes; yields (page number, [(root number, intact rows, corrupted rows)]) in page order'''
+
+        #Pages are independent of each other, so they are split into contiguous ranges handed out to the workers.
+        #Each worker opens its own file handle and buffer; imap returns the ranges in submission order,
+        #therefore the results come out in the same order as in a serial scan.
+        chunk = max(1, min(256, len(work)//(self.jobs*4)))
+        shards = [(work[i:i+chunk], roots) for i in range(0, len(work), chunk)]
+
+        #a database in memory is inherited by forked workers, and copied to the others
+        global _shared_image
+        image = None
+        if self.image is not None:
+            _shared_image = self.image
+            if multiprocessing.get_start_method() != 'fork': image = bytes(self.image)
+
+        initargs = (self.filepath, self.corr, self.nostrict, self.rrt.dbs.tables, self.rrt.dbs.profiles, self.use_mmap, image, self.rrt.scripts, self.rrt.exhaustive)
+        with multiprocessing.Pool(self.jobs, _init_scan_worker, initargs) as pool:
+            for results in pool.imap(_scan_pages, shards):
+                for result in results:
+                    yield result
+
+
+_worker_rrt = None
+_shared_image = None
+
+def _init_scan_worker(filepath, corr, nostrict, tables, profiles, use_mmap, image=None, scripts=DEFAULT_SCRIPTS, exhaustive=False):
+    '''Opens a private file handle and buffer in a scan worker process, or uses the database in memory of the main process'''
+    global _worker_rrt
+    if image is None: image = _shared_image
+    if image is not None:
+        _worker_rrt = RecordRetriever(None, filepath, corr, nostrict, image, DBSchema(filepath, tables, profiles), scripts=scripts, exhaustive=exhaustive)
+        return
+    fileobj = open(filepath, 'rb')
+    _worker_rrt = RecordRetriever(fileobj, filepath, corr, nostrict, open_buffer(fileobj, use_mmap), DBSchema(filepath, tables, profiles), scripts=scripts, exhaustive=exhaustive)
+
+def _scan_pages(shard):
+    '''Scans a range of pages in a worker process; returns the results tagged with their page number'''
+    work, roots = shard
+    return [(pageno, _worker_rrt.scan_tables(regions, roots)) for pageno, regions in work]
 
         
 
@@ -958,6 +2031,39 @@ More on usage options:
     
     parser = argparse.ArgumentParser(description = 'SQLiteRet: retrieve deleted rows from SQLite databases and dump them.\nMay require user interaction.', epilog=epilog, formatter_class = argparse.RawDescriptionHelpFormatter)
     parser.add_argument('file', help='database file') 
+    add_carving_arguments(parser)
+    parser.add_argument('--key', help='key of a SQLCipher database (e.g. EnMicroMsg.db): its pages are decrypted in memory and carved from there')
+    parser.add_argument('--cipher-page-size', type=int, default=1024, metavar='N', help='SQLCipher page size (default: 1024)')
+    parser.add_argument('--kdf-iter', type=int, default=4000, metavar='N', help='SQLCipher PBKDF2 iterations (default: 4000)')
+    args = parser.parse_args()
+
+    if not args.key:
+        carve(args, args.file)
+        return
+
+    #the decrypted pages keep the free space of the file, which an export with sqlcipher_export would drop
+    try:
+        import sqlcipher_key
+    except ImportError as ex:
+        print('Decryption requires pycryptodome (pip install pycryptodome):', ex)
+        exit(0)
+    settings = {'page_size': args.cipher_page_size, 'kdf_iter': args.kdf_iter, 'reserve': sqlcipher_key.RESERVE, 'kdf_algorithm': sqlcipher_key.KDF_ALGORITHM}
+    image = sqlcipher_key.decrypt_database(args.file, args.key, args.cipher_page_size, args.kdf_iter, use_mmap = not args.no_mmap)
+    if image is None:
+        #other SQLCipher versions or builds: find the settings the key opens the database with
+        settings = sqlcipher_key.probe(args.file, [args.key])
+        if settings is None:
+            print('The key does not open the database with any of the usual settings.\nExiting program.')
+            exit(0)
+        print('SQLCipher settings: %(version)s, page size %(page_size)d, kdf_iter %(kdf_iter)d, PBKDF2-HMAC-%(kdf_algorithm)s, %(reserve)d reserved bytes' % settings)
+        image = sqlcipher_key.decrypt_database(args.file, args.key, settings['page_size'], settings['kdf_iter'], settings['reserve'], not args.no_mmap, settings['kdf_algorithm'])
+    #the WAL file and journal are encrypted as the database is
+    decrypt = sqlcipher_key.page_decrypter(args.file, args.key, settings['page_size'], settings['kdf_iter'], settings['reserve'], settings['kdf_algorithm'])
+    carve(args, args.file, image, decrypt)
+
+
+def add_carving_arguments(parser):
+    '''Adds the options of the carving of deleted rows to an argument parser'''
     parser.add_argument('-c','--corrupted', action='store_true', default=False, help='also attempt retrieval of corrupted rows')
     parser.add_argument('-ns','--nostrict', action='store_true', help='run the program in non-strict mode')
     parser.add_argument('-o','--output', metavar='outputFile', default=False, help='specify output file')
@@ -965,28 +2071,92 @@ More on usage options:
     mode.add_argument('-t','--tab', action='store_true', help='print results as lists of tab-separated values')
     mode.add_argument('-r','--raw', action='store_true', help='print results as tuples')
     parser.add_argument('-v', '--verbose', action='store_true', help='print additional information')
-    args = parser.parse_args()
-
-    dbscanner = DBScanner(filepath = args.file, out = args.output, corr = args.corrupted, nostrict = args.nostrict, tab=args.tab, raw=args.raw, verbose = args.verbose)
-    tt = global_undelete_data
-    dbscanner.all_table_scan()
-    json ={}
-    remain_list =[]
-    for line in global_undelete_data:
-        json[line[1]]=line[0]
-    for msg in global_data_sets:
-        if msg[1] not in json:
-            remain_list.append(msg)
-    write_data(remain_list)
+    parser.add_argument('-f', '--format', choices=['csv', 'tsv'], default='csv', help='format of the msg and deleted files (default: csv)')
+    parser.add_argument('--flush-size', type=int, default=1000, metavar='N', help='write recovered rows to disk in batches of at least N rows (default: 1000)')
+    parser.add_argument('--table', action='append', metavar='NAME', help='carve this table (may be repeated); by default, every table with a profile is carved')
+    parser.add_argument('--profile', action='append', default=[], metavar='FILE', help='load table profiles from a JSON file (may be repeated)')
+    parser.add_argument('--bloom', action='store_true', help='keep the live messages in a Bloom filter instead of a hash set')
+    parser.add_argument('--fp-rate', type=float, default=0.001, metavar='P', help='false-positive rate of the Bloom filter (default: 0.001)')
+    parser.add_argument('--resume', action='store_true', help='resume an interrupted scan from its checkpoint')
+    parser.add_argument('--freespace', action='store_true', help='scan only the free space found from the freelist and the b-tree page headers')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='scan pages in N worker processes')
+    parser.add_argument('--no-mmap', action='store_true', help='read the database into memory instead of memory-mapping it')
+    parser.add_argument('--scripts', type=script_classes, default=DEFAULT_SCRIPTS, metavar='LIST', help='comma-separated script classes a message must hold a character of, among %s (default: %s)' % (', '.join(sorted(SCRIPT_CLASSES)), ','.join(DEFAULT_SCRIPTS)))
+    parser.add_argument('--exhaustive', action='store_true', help='probe every byte inside the rows already found, for records overlapping others')
+    parser.add_argument('--wal', nargs='?', const='', metavar='FILE', help='also carve the page images of the write-ahead log (default: the database file name followed by -wal)')
+    parser.add_argument('--journal', nargs='?', const='', metavar='FILE', help='also carve the page images of the rollback journal (default: the database file name followed by -journal)')
+
+
+def read_history(args, path, buf=None, decrypt=None):
+    '''Returns the PageHistory of the WAL file and journal selected by the --wal and --journal options, None if there are none'''
+
+    files = [(read, option or path+suffix) for read, option, suffix in (('read_wal', args.wal, '-wal'), ('read_journal', args.journal, '-journal')) if option is not None]
+    if not files: return None
+    if buf is None:
+        with open(path, 'rb') as f: buf = f.read(100)
+    pagesize = struct.unpack('>H', buf[16:18])[0]
+    history = PageHistory(65536 if pagesize == 1 else pagesize, decrypt)
+    for read, history_path in files:
+        if not os.path.exists(history_path):
+            print(history_path, 'not found, skipping it')
+            continue
+        print('Read %d page images from %s' % (getattr(history, read)(history_path), history_path))
+    return history
+
+
+def carve(args, path, buf=None, decrypt=None):
+    '''Carves the deleted rows of a database with the options of add_carving_arguments; buf is the database when it is already in memory,
+    decrypt a function decrypting the page images of its WAL file and journal, given their page number'''
+
+    #The database file is opened as immutable, so that neither it nor its WAL file and journal are changed: the committed
+    #pages of the WAL file are written into an image of the database in memory instead, as a checkpoint would, so that the
+    #rows they hold count as live (Python 3.11 and later, which open an image in memory)
+    history = read_history(args, path, buf, decrypt)
+    if history is not None and history.committed and buf is None:
+        if hasattr(sqlite3.Connection, 'deserialize'):
+            with open(path, 'rb') as f: buf = bytearray(f.read())
+        else:
+            print('The committed pages of the WAL file are carved but not applied to the database: their rows are not taken as live')
+    if history is not None and buf is not None: buf = history.checkpoint(buf)
+
+    registry = SchemaRegistry()
+    for profile_path in args.profile: registry.load(profile_path)
+
+    dbscanner = DBScanner(filepath = path, buf = buf, out = args.output, corr = args.corrupted, nostrict = args.nostrict, tab=args.tab, raw=args.raw, verbose = args.verbose, use_mmap = not args.no_mmap, jobs = args.jobs, freespace = args.freespace, registry = registry, tables = args.table, scripts = args.scripts, exhaustive = args.exhaustive)
+    profiles = dbscanner.rrt.dbs.profiles
+    print('Carving tables:', ', '.join(profile.table for profile in profiles.values()))
+
+    #hashes of the live messages of each table, streamed from the database
+    live = dict((profile.table, LiveMessages(dbscanner.rrt.dbs, root, profile.key, bloom = args.bloom, fp_rate = args.fp_rate)) for root, profile in profiles.items())
+    dbscanner.rrt.dbs.close()
+
+    #the checkpoint records the pages done and the size of the outputs at each flush
+    options = {'tables': sorted(profile.table for profile in profiles.values()), 'freespace': args.freespace, 'corrupted': args.corrupted,
+               'nostrict': args.nostrict, 'scripts': sorted(args.scripts), 'exhaustive': args.exhaustive, 'wal': args.wal, 'journal': args.journal}
+    checkpoint = Checkpoint('msg.'+args.format+'.checkpoint', path, dbscanner.filesize, dbscanner.pagesize, options)
+    try:
+        resume = args.resume and checkpoint.load()
+    except ValueError as ex:
+        print('Cannot resume the scan:', ex)
+        print('Exiting program.')
+        exit(0)
+    if args.resume and not resume:
+        print('No checkpoint found for this database, starting a new scan')
+    dbscanner.writer = RowWriter(live, args.format, args.flush_size, checkpoint, resume)
+    #the rows of the database are not written again from the page images of the WAL file and journal
+    if history is not None: dbscanner.seen = set()
+    try:
+        dbscanner.all_table_scan()
+        if history is not None: dbscanner.history_scan(history)
+    finally:
+        dbscanner.writer.close()
     #dbscanner.execute()
 
     
 
-main()
-
 if  __name__ == '__main__':
+    main()
     print('total step:',global_count)
-    write()
 
 
             
@@ -0,0 +1,85 @@
+# Tests of the scheduling of the keyspace search.
+
+import threading
+
+import keyspace
+
+
+def test_key_of():
+    assert keyspace.key_of(0) == '0000000'
+    assert keyspace.key_of(keyspace.KEYSPACE_END) == 'fffffff'
+
+
+def test_first_chunk():
+    scheduler = keyspace.KeyspaceScheduler(workers=4)
+    assert scheduler.next_chunk() == (0, keyspace.FIRST_CHUNK - 1)
+
+
+def test_chunk_from_rate():
+    scheduler = keyspace.KeyspaceScheduler(workers=4, chunk_seconds=2.0)
+    scheduler.done(1000, 1.0)
+    assert scheduler.chunk_size() == 2000
+    #the rate is smoothed over the ranges done
+    scheduler.done(2000, 1.0)
+    assert scheduler.chunk_size() == int((0.7 * 1000 + 0.3 * 2000) * 2.0)
+    #ranges with no keys or no time leave the rate as it is
+    scheduler.done(0, 1.0)
+    scheduler.done(10, 0)
+    assert scheduler.chunk_size() == int((0.7 * 1000 + 0.3 * 2000) * 2.0)
+
+
+def test_chunk_bounds():
+    #no more than half a share of what is left
+    scheduler = keyspace.KeyspaceScheduler(0, 9999, workers=4)
+    scheduler.done(1000000, 1.0)
+    assert scheduler.chunk_size() == 10000 // 8
+    #and never less than MIN_CHUNK
+    scheduler = keyspace.KeyspaceScheduler(0, 99, workers=4)
+    assert scheduler.chunk_size() == keyspace.MIN_CHUNK
+    scheduler = keyspace.KeyspaceScheduler(workers=1)
+    scheduler.done(1, 1000.0)
+    assert scheduler.chunk_size() == keyspace.MIN_CHUNK
+
+
+def test_chunks_cover_keyspace():
+    scheduler = keyspace.KeyspaceScheduler(100, 50000, workers=3)
+    scheduler.done(5000, 1.0)
+    chunks = []
+    chunk = scheduler.next_chunk()
+    while chunk is not None:
+        chunks.append(chunk)
+        chunk = scheduler.next_chunk()
+    assert chunks[0][0] == 100 and chunks[-1][1] == 50000
+    for (start, end), (next_start, next_end) in zip(chunks, chunks[1:]):
+        assert start <= end and next_start == end + 1
+    #the ranges get smaller towards the end of the keyspace
+    assert chunks[-1][1] - chunks[-1][0] < chunks[0][1] - chunks[0][0]
+
+
+def test_run_workers():
+    scheduler = keyspace.KeyspaceScheduler(0, 9999, workers=4)
+    found = threading.Event()
+    searched = []
+    lock = threading.Lock()
+
+    def search(start, end):
+        with lock:
+            searched.extend(range(start, end + 1))
+        if start <= 4321 <= end:
+            found.set()
+        return end - start + 1
+
+    class Out(object):
+        def __init__(self):
+            self.lines = []
+        def write(self, text):
+            self.lines.append(text)
+        def flush(self):
+            pass
+
+    out = Out()
+    keyspace.run_workers(scheduler, search, found, out=out)
+    assert found.is_set()
+    assert 4321 in searched
+    assert len(searched) == len(set(searched))
+    assert out.lines
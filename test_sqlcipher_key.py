@@ -0,0 +1,137 @@
+# Tests of the verification of candidate keys and of the decryption of SQLCipher databases.
+#
+# The encrypted databases are built from a plain one with the settings of WeChat, so that
+# the tests need neither SQLCipher nor a real EnMicroMsg.db.
+
+import os
+import sqlite3
+
+import pytest
+
+pytest.importorskip('Crypto')
+from Crypto.Cipher import AES
+
+import sqlcipher_key
+
+
+KEY = 'abc1234'
+
+
+def encrypt_database(plain, key, page_size=sqlcipher_key.PAGE_SIZE, kdf_iter=sqlcipher_key.KDF_ITER, reserve=sqlcipher_key.RESERVE):
+    '''Encrypts a plain SQLite image page by page as SQLCipher does, the IV at the start of the reserved bytes'''
+    salt = os.urandom(sqlcipher_key.SALT_SIZE)
+    derived = sqlcipher_key.derive_key(key, salt, kdf_iter)
+    pages = []
+    for offset in range(0, len(plain), page_size):
+        page = plain[offset:offset + page_size]
+        start = sqlcipher_key.SALT_SIZE if offset == 0 else 0
+        iv = os.urandom(sqlcipher_key.BLOCK_SIZE)
+        encrypted = AES.new(derived, AES.MODE_CBC, iv).encrypt(bytes(page[start:page_size - reserve]))
+        pages.append((salt if offset == 0 else b'') + encrypted + iv + os.urandom(reserve - sqlcipher_key.BLOCK_SIZE))
+    return b''.join(pages)
+
+
+@pytest.fixture
+def plain(tmp_path):
+    '''Image of a plain database whose header declares the reserved bytes of the encryption'''
+    path = str(tmp_path / 'plain.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA page_size=1024')
+    conn.execute('CREATE TABLE message (msgId INTEGER PRIMARY KEY, content TEXT)')
+    conn.executemany('INSERT INTO message (content) VALUES (?)', [('message %d' % i,) for i in range(100)])
+    conn.commit()
+    conn.close()
+    with open(path, 'rb') as f:
+        image = bytearray(f.read())
+    image[20] = sqlcipher_key.RESERVE
+    return bytes(image)
+
+
+@pytest.fixture
+def encrypted(tmp_path, plain):
+    path = str(tmp_path / 'EnMicroMsg.db')
+    with open(path, 'wb') as f:
+        f.write(encrypt_database(plain, KEY))
+    return path
+
+
+def test_check(encrypted):
+    verifier = sqlcipher_key.KeyVerifier(encrypted)
+    assert verifier.check(KEY)
+    assert not verifier.check('abc1235')
+    assert not verifier.check('')
+
+
+def test_find(encrypted):
+    verifier = sqlcipher_key.KeyVerifier(encrypted)
+    keys = ['%07x' % i for i in range(100)] + [KEY]
+    assert verifier.find(keys, batch_size=16) == KEY
+    assert verifier.find(keys[:100]) is None
+
+
+def test_header_ok():
+    #bytes 16 to 23 of the header of a database of 1024-byte pages with 16 reserved bytes
+    plain = bytearray(b'\x04\x00\x01\x01\x10\x40\x20\x20')
+    assert sqlcipher_key.header_ok(plain, 1024, 16)
+    assert not sqlcipher_key.header_ok(plain, 4096, 16)
+    assert not sqlcipher_key.header_ok(plain, 1024, 48)
+    plain[5] = 0
+    assert not sqlcipher_key.header_ok(plain, 1024, 16)
+
+
+def test_decrypt_database(encrypted, plain):
+    reserve = sqlcipher_key.RESERVE
+    image = sqlcipher_key.decrypt_database(encrypted, KEY, use_mmap=False)
+    assert len(image) == len(plain)
+    for offset in range(0, len(plain), sqlcipher_key.PAGE_SIZE):
+        end = offset + sqlcipher_key.PAGE_SIZE - reserve
+        assert image[offset:end] == plain[offset:end]
+    assert sqlcipher_key.decrypt_database(encrypted, 'abc1235') is None
+
+
+def test_page_decrypter(encrypted, plain):
+    decrypt = sqlcipher_key.page_decrypter(encrypted, KEY)
+    with open(encrypted, 'rb') as f:
+        f.seek(sqlcipher_key.PAGE_SIZE)
+        page = f.read(sqlcipher_key.PAGE_SIZE)
+    end = 2 * sqlcipher_key.PAGE_SIZE - sqlcipher_key.RESERVE
+    assert decrypt(2, page)[:-sqlcipher_key.RESERVE] == plain[sqlcipher_key.PAGE_SIZE:end]
+
+
+def test_probe(encrypted):
+    settings = sqlcipher_key.probe(encrypted, ['abc1235', KEY])
+    assert settings['key'] == KEY
+    assert settings['version'] == 'wechat'
+    assert (settings['page_size'], settings['kdf_iter'], settings['kdf_algorithm'], settings['reserve']) == (1024, 4000, 'sha1', 16)
+    assert sqlcipher_key.probe(encrypted, ['abc1235']) is None
+
+
+def test_probe_sqlcipher4(tmp_path):
+    sqlcipher3 = pytest.importorskip('sqlcipher3')
+    path = str(tmp_path / 'v4.db')
+    conn = sqlcipher3.connect(path)
+    conn.execute("PRAGMA key = '%s'" % KEY)
+    conn.execute('PRAGMA cipher_compatibility = 4')
+    conn.execute('CREATE TABLE message (msgId INTEGER PRIMARY KEY, content TEXT)')
+    conn.execute("INSERT INTO message (content) VALUES ('hello')")
+    conn.commit()
+    conn.close()
+
+    settings = sqlcipher_key.probe(path, [KEY])
+    assert settings['version'] == 'sqlcipher4'
+    verifier = sqlcipher_key.KeyVerifier(path, settings['page_size'], settings['kdf_iter'], settings['reserve'], settings['kdf_algorithm'])
+    assert verifier.check(KEY)
+    assert not verifier.check('abc1235')
+
+
+def test_structure_check(tmp_path, encrypted):
+    assert sqlcipher_key.structure_check(encrypted) == []
+    truncated = str(tmp_path / 'truncated.db')
+    with open(encrypted, 'rb') as f, open(truncated, 'wb') as out:
+        out.write(f.read(1500))
+    problems = sqlcipher_key.structure_check(truncated)
+    assert 'not a multiple of the page size' in problems[0]
+    assert problems[1].endswith('none')
+    path = str(tmp_path / 'plain.db')
+    sqlite3.connect(path).execute('CREATE TABLE t (a)').connection.close()
+    assert 'plain SQLite database' in sqlcipher_key.structure_check(path)[0]
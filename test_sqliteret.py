@@ -0,0 +1,409 @@
+# Tests of the carving of deleted rows: the record decoding, the free space of the pages,
+# the page images of the WAL file and journal, and the checkpoint of an interrupted scan.
+#
+# The databases are built with the sqlite3 module, with secure_delete off so that the
+# deleted rows stay in the file.
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import struct
+
+import pytest
+
+import sqliteret
+
+
+CJK = [chr(c) for c in range(0x4e00, 0x4e00 + 500)]
+
+
+def message(rnd, low=5, high=40):
+    return ''.join(rnd.choice(CJK) for _ in range(rnd.randint(low, high)))
+
+
+def create_database(path, journal_mode='delete'):
+    '''Returns a connection to a new database of 1024-byte pages holding a table of messages'''
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA page_size=1024')
+    conn.execute('PRAGMA secure_delete=OFF')
+    conn.execute('PRAGMA journal_mode=%s' % journal_mode)
+    conn.execute('PRAGMA wal_autocheckpoint=0')
+    conn.execute('CREATE TABLE FTS5IndexMessage_content (id INTEGER PRIMARY KEY, c0 TEXT)')
+    return conn
+
+
+def insert_messages(conn, messages):
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO FTS5IndexMessage_content (c0) VALUES (?)', [(m,) for m in messages])
+    conn.execute('COMMIT')
+
+
+def carve(directory, path, *options):
+    '''Carves a database with the command-line options into the directory; returns the lines of the file of the deleted messages'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    sqliteret.add_carving_arguments(parser)
+    args = parser.parse_args([path] + list(options))
+    cwd = os.getcwd()
+    os.chdir(str(directory))
+    try:
+        sqliteret.carve(args, args.file)
+    finally:
+        os.chdir(cwd)
+    with open(os.path.join(str(directory), 'deleted.csv'), encoding='utf-8') as f:
+        return f.read().splitlines()[1:]
+
+
+def retriever(buf):
+    return sqliteret.RecordRetriever(None, '', False, False, buf=buf, dbs=sqliteret.DBSchema('', {}, {}))
+
+
+@pytest.mark.parametrize('data, value, length', [
+    (b'\x00', 0, 1),
+    (b'\xf0', 240, 1),
+    (b'\xf1\x00', 240, 2),
+    (b'\xf8\xff', 240 + 256 * 7 + 255, 2),
+    (b'\xf9\x01\x02', 2288 + 256 + 2, 3),
+    (b'\xfa\x01\x02\x03', 0x010203, 4),
+    (b'\xff\x01\x02\x03\x04\x05\x06\x07\x08', 0x0102030405060708, 9),
+])
+def test_varint_from_buffer(data, value, length):
+    reader = sqliteret.BufferVarintReader(b'\x00' + data)
+    assert reader.varint_from_buffer(1) == (value, 1 + length)
+
+
+def test_varint_from_buffer_truncated():
+    with pytest.raises(IndexError):
+        sqliteret.BufferVarintReader(b'\xfb\x01\x02').varint_from_buffer(0)
+
+
+@pytest.mark.parametrize('data, value, length', [
+    (b'\x7f', 127, 1),
+    (b'\x81\x00', 128, 2),
+    (b'\xff\x7f', 16383, 2),
+    (b'\x81\x80\x00', 16384, 3),
+    (b'\x80\x01', None, 1),
+    (b'\x81\x81\x81\x01', None, 3),
+])
+def test_varint_integer(data, value, length):
+    assert sqliteret.BufferVarintReader(data).varint_integer(0) == (value, length)
+
+
+@pytest.mark.parametrize('serial, data, value', [
+    (0, b'', None),
+    (1, b'\xff', -1),
+    (2, b'\x01\x00', 256),
+    (3, b'\x80\x00\x00', -0x800000),
+    (4, b'\x00\x01\x00\x00', 65536),
+    (5, b'\x00\x01\x00\x00\x00\x00', 2 ** 32),
+    (6, b'\xff' * 8, -1),
+    (7, struct.pack('>d', 1.5), 1.5),
+    (8, b'', 0),
+    (9, b'', 1),
+    (12, b'', b''),
+    (19, b'abc', b'abc'),
+    (20, b'\x00\x01\x02\x03', b'\x00\x01\x02\x03'),
+])
+def test_pl_decode_at(serial, data, value):
+    rrt = retriever(b'\x00\x00' + data + b'\x00')
+    assert rrt.pl_decode_at(serial, 2) == (value, 2 + len(data))
+
+
+def test_pl_decode_at_errors():
+    rrt = retriever(b'ab')
+    with pytest.raises(IndexError):
+        rrt.pl_decode_at(6, 0)
+    with pytest.raises(IndexError):
+        rrt.pl_decode_at(19, 0)
+    with pytest.raises(ValueError):
+        rrt.pl_decode_at(10, 0)
+
+
+def test_local_payload_size(tmp_path):
+    path = str(tmp_path / 'test.db')
+    create_database(path).close()
+    with open(path, 'rb') as f:
+        rrt = retriever(f.read())
+    #usable size 1024: at most 989 bytes in the page, at least 103
+    assert rrt.local_payload_size(989) == 989
+    #the rest fills whole overflow pages of 1020 bytes, unless that leaves more than the maximum in the page
+    assert rrt.local_payload_size(2000) == 2000 - 1020
+    assert rrt.local_payload_size(5000) == 5000 - 4 * 1020
+    assert rrt.local_payload_size(990) == 103
+
+
+def test_overflow_payload(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path)
+    rnd = random.Random(1)
+    long_message = message(rnd, 1500, 1500)
+    insert_messages(conn, [message(rnd) for _ in range(50)] + [long_message] + [message(rnd) for _ in range(50)])
+    conn.close()
+    with open(path, 'rb') as f:
+        rrt = retriever(f.read())
+
+    #the record of the message: header size, null rowid alias, text serial, then the text
+    text = long_message.encode('utf-8')
+    header = bytes([4, 0, 0x80 + (len(text) * 2 + 13 >> 7), len(text) * 2 + 13 & 0x7f])
+    start = rrt.buf.find(header + text[:30])
+    assert start > 0
+    assert rrt.overflow_payload(start, len(header) + len(text)) == header + text
+    #a broken chain: the pointer to the first overflow page is past the end of the database
+    local = rrt.local_payload_size(len(header) + len(text))
+    buf = bytearray(rrt.buf)
+    buf[start + local:start + local + 4] = b'\xff\xff\xff\xff'
+    assert retriever(bytes(buf)).overflow_payload(start, len(header) + len(text)) is None
+
+
+def test_deleted_overflow_row(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path)
+    rnd = random.Random(2)
+    long_message = message(rnd, 1500, 1500)
+    insert_messages(conn, [message(rnd) for _ in range(100)] + [long_message] + [message(rnd) for _ in range(100)])
+    #a freelist trunk page first, so that the overflow pages of the deleted row become untouched leaf pages
+    conn.execute('CREATE TABLE filler (x)')
+    conn.execute('INSERT INTO filler VALUES (?)', ('x' * 5000,))
+    conn.execute('DROP TABLE filler')
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE c0 = ?', (long_message,))
+    conn.close()
+
+    rows = carve(tmp_path, path)
+    assert [row for row in rows if long_message in row]
+
+
+def test_free_space_map():
+    pagesize = 1024
+    buf = bytearray(4 * pagesize)
+    buf[16:18] = struct.pack('>H', pagesize)
+    #freelist: trunk page 3 listing leaf page 4
+    buf[32:36] = struct.pack('>I', 3)
+    buf[2 * pagesize + 4:2 * pagesize + 12] = struct.pack('>II', 1, 4)
+    #page 2, a table leaf page: 2 cells, cell content from 0x200, freeblocks at 0x300 (32 bytes) and 0x380 (16 bytes)
+    page = pagesize
+    buf[page:page + 8] = struct.pack('>BHHHB', 13, 0x300, 2, 0x200, 0)
+    buf[page + 0x300:page + 0x304] = struct.pack('>HH', 0x380, 0x20)
+    buf[page + 0x380:page + 0x384] = struct.pack('>HH', 0, 0x10)
+
+    free = sqliteret.FreeSpaceMap(bytes(buf), pagesize)
+    assert free.trunks == {3: 1} and free.leaves == {4}
+    assert free.page_regions(2) == [(page + 12, page + 0x200), (page + 0x300, page + 0x320), (page + 0x380, page + 0x390)]
+    assert free.page_regions(3) == [(2 * pagesize + 12, 3 * pagesize)]
+    assert free.page_regions(4) == [(3 * pagesize, 4 * pagesize)]
+
+
+def test_free_space_map_regions(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path)
+    rnd = random.Random(3)
+    insert_messages(conn, [message(rnd) for _ in range(300)])
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE id % 3 = 0')
+    conn.close()
+    with open(path, 'rb') as f:
+        buf = f.read()
+
+    free = sqliteret.FreeSpaceMap(buf, 1024)
+    rootno = sqlite3.connect(path).execute("SELECT rootpage FROM sqlite_master WHERE name = 'FTS5IndexMessage_content'").fetchone()[0]
+    pages = free.btree_pages(rootno)
+    assert len(pages) > 2
+    freeblocks = 0
+    for pageno in pages:
+        start = (pageno - 1) * 1024
+        for first, end in free.page_regions(pageno):
+            assert start <= first < end <= start + 1024
+            #a freeblock holds its own size in its header
+            if struct.unpack('>H', buf[first + 2:first + 4])[0] == end - first and first != start + 8:
+                freeblocks += 1
+    assert freeblocks
+
+
+def test_read_wal(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path, 'wal')
+    rnd = random.Random(4)
+    insert_messages(conn, [message(rnd) for _ in range(100)])
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    insert_messages(conn, ['新的消息%d' % i for i in range(20)])
+    conn.execute("UPDATE FTS5IndexMessage_content SET c0 = '改过的消息' WHERE id = 50")
+    #copied while the connection is open, before the WAL file is checkpointed
+    for suffix in ('', '-wal'):
+        shutil.copy(path + suffix, str(tmp_path / ('copy.db' + suffix)))
+    conn.close()
+
+    copy = str(tmp_path / 'copy.db')
+    history = sqliteret.PageHistory(1024)
+    frames = history.read_wal(copy + '-wal')
+    assert frames == (os.path.getsize(copy + '-wal') - sqliteret.WAL_HEADER_SIZE) // (sqliteret.WAL_FRAME_HEADER_SIZE + 1024)
+    assert history.committed and history.dbsize
+    assert all(state == 'committed' for pageno, version, source, state, image in history.images)
+
+    #the checkpoint in memory gives the database as SQLite sees it
+    with open(copy, 'rb') as f:
+        image = history.checkpoint(bytearray(f.read()))
+    assert len(image) == history.dbsize * 1024
+    assert '改过的消息'.encode('utf-8') in image and '新的消息19'.encode('utf-8') in image
+    #the page replaced by the checkpoint is kept as an older image
+    assert any(state == 'checkpointed' for pageno, version, source, state, image in history.images)
+    #and the files are left as they were
+    assert os.path.getsize(copy + '-wal') > 0
+
+
+def test_read_wal_other_database(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path, 'wal')
+    insert_messages(conn, ['消息'])
+    shutil.copy(path + '-wal', str(tmp_path / 'copy-wal'))
+    conn.close()
+    assert sqliteret.PageHistory(4096).read_wal(str(tmp_path / 'copy-wal')) == 0
+
+
+def test_read_journal(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path, 'persist')
+    rnd = random.Random(5)
+    insert_messages(conn, [message(rnd) for _ in range(100)])
+    old = conn.execute('SELECT c0 FROM FTS5IndexMessage_content WHERE id = 50').fetchone()[0]
+    conn.execute("UPDATE FTS5IndexMessage_content SET c0 = '改过的消息' WHERE id = 50")
+    conn.close()
+
+    #the persisted journal keeps the page images from before the last transaction
+    history = sqliteret.PageHistory(1024)
+    assert history.read_journal(path + '-journal') > 0
+    images = [(state, image) for pageno, version, source, state, image in history.images]
+    assert any(state == 'persisted journal' and old.encode('utf-8') in image for state, image in images)
+
+
+def test_read_hot_journal(tmp_path):
+    pagesize = 1024
+    page = bytes(range(256)) * 4
+    #a header with its number of records, padded to the sector size, then the records: page number, image, checksum
+    header = sqliteret.JOURNAL_MAGIC + struct.pack('>5I', 2, 0, 10, 512, pagesize)
+    data = header.ljust(512, b'\x00')
+    data += struct.pack('>I', 3) + page + b'\x00' * 4
+    data += struct.pack('>I', 7) + page[::-1] + b'\x00' * 4
+    path = str(tmp_path / 'test.db-journal')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    history = sqliteret.PageHistory(pagesize)
+    assert history.read_journal(path) == 2
+    assert [(pageno, state, image) for pageno, version, source, state, image in history.images] == [(3, 'journal', page), (7, 'journal', page[::-1])]
+
+
+def test_page_history_dedupe():
+    history = sqliteret.PageHistory(1024)
+    page = b'\x0d' + b'\x00' * 1023
+    history.index(2, 'wal frame 1', 'committed', page)
+    history.index(2, 'wal frame 2', 'committed', page)
+    history.index(2, 'wal frame 3', 'committed', page[:-1] + b'\x01')
+    assert [(pageno, version, source) for pageno, version, source, state, image in history.images] == [(2, 1, 'wal frame 1'), (2, 2, 'wal frame 3')]
+
+
+def test_history_rows_written_once(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path, 'wal')
+    rnd = random.Random(6)
+    messages = [message(rnd) for _ in range(300)]
+    insert_messages(conn, messages)
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE id BETWEEN 150 AND 170')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    #the same row inserted and deleted twice: its record is in several frames of the WAL file, and the rows deleted
+    #before are both in the pages of the database and in their older images replaced by the checkpoint
+    conn.execute('BEGIN')
+    conn.execute("INSERT INTO FTS5IndexMessage_content (id, c0) VALUES (155, '早先的消息144条')")
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE id = 155')
+    conn.execute("INSERT INTO FTS5IndexMessage_content (id, c0) VALUES (156, '早先的消息144条')")
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE id = 156')
+    conn.execute('COMMIT')
+    for suffix in ('', '-wal'):
+        shutil.copy(path + suffix, str(tmp_path / ('copy.db' + suffix)))
+    conn.close()
+
+    copy = str(tmp_path / 'copy.db')
+    (tmp_path / 'database').mkdir()
+    database = carve(tmp_path / 'database', copy)
+    rows = carve(tmp_path, copy, '--wal')
+    #the deleted rows of the database are not written again from its older page images
+    for deleted in messages[149:170]:
+        assert len([row for row in rows if deleted in row]) <= len([row for row in database if deleted in row])
+    assert len(set(rows) & set(database)) > 10
+    assert len([row for row in rows if '早先的消息144条' in row]) == 1
+    #resumed, the rows of the WAL file are not written again
+    assert carve(tmp_path, copy, '--wal', '--resume') == rows
+
+
+def test_checkpoint(tmp_path):
+    output = tmp_path / 'deleted.csv'
+    output.write_text('id,message\n1,消息\n', encoding='utf-8')
+    path = str(tmp_path / 'msg.csv.checkpoint')
+    options = {'freespace': False, 'tables': ['FTS5IndexMessage_content']}
+
+    checkpoint = sqliteret.Checkpoint(path, 'test.db', 10240, 1024, options)
+    assert not checkpoint.load()
+    checkpoint.add([3, 4, 5])
+    checkpoint.add([7, 6])
+    checkpoint.add([9])
+    checkpoint.history = 4
+    checkpoint.save({str(output): output.stat().st_size})
+
+    loaded = sqliteret.Checkpoint(path, 'test.db', 10240, 1024, options)
+    assert loaded.load()
+    assert loaded.ranges == [[3, 7], [9, 9]]
+    assert 5 in loaded and 8 not in loaded
+    assert loaded.history == 4
+    assert loaded.offsets == {str(output): output.stat().st_size}
+
+    #another database, or other options
+    with pytest.raises(ValueError, match='size'):
+        sqliteret.Checkpoint(path, 'test.db', 20480, 1024, options).load()
+    with pytest.raises(ValueError, match='freespace'):
+        sqliteret.Checkpoint(path, 'test.db', 10240, 1024, dict(options, freespace=True)).load()
+    #an output file truncated since
+    output.write_text('id\n', encoding='utf-8')
+    with pytest.raises(ValueError, match='truncated'):
+        loaded.load()
+    output.unlink()
+    with pytest.raises(ValueError, match='removed'):
+        loaded.load()
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path)
+    rnd = random.Random(7)
+    insert_messages(conn, [message(rnd) for _ in range(500)])
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE id % 4 = 0')
+    conn.close()
+
+    rows = carve(tmp_path, path, '--flush-size', '10')
+    assert rows
+    #a finished scan resumed writes nothing more
+    assert carve(tmp_path, path, '--resume') == rows
+    #a scan with other options is not resumed
+    with pytest.raises(SystemExit):
+        carve(tmp_path, path, '--resume', '--freespace')
+    assert carve(tmp_path, path, '--resume') == rows
+
+
+def test_resume_interrupted(tmp_path, monkeypatch):
+    path = str(tmp_path / 'test.db')
+    conn = create_database(path)
+    rnd = random.Random(7)
+    insert_messages(conn, [message(rnd) for _ in range(500)])
+    conn.execute('DELETE FROM FTS5IndexMessage_content WHERE id % 4 = 0')
+    conn.close()
+    (tmp_path / 'full').mkdir()
+    rows = carve(tmp_path / 'full', path)
+
+    #the scan is interrupted after a few pages, then resumed
+    page_done = sqliteret.RowWriter.page_done
+    def interrupt(writer, pageno):
+        page_done(writer, pageno)
+        if pageno == 8: raise KeyboardInterrupt
+    monkeypatch.setattr(sqliteret.RowWriter, 'page_done', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        carve(tmp_path, path, '--flush-size', '10')
+    monkeypatch.setattr(sqliteret.RowWriter, 'page_done', page_done)
+    assert carve(tmp_path, path, '--resume') == rows
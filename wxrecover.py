@@ -0,0 +1,184 @@
+# -*- coding:utf-8 -*-
+#!/usr/bin/env python3
+#
+# Recovery of the deleted messages of an encrypted EnMicroMsg.db in a single process:
+# search of the key, decryption in memory and carving of the deleted rows with SQLiteRet.
+#
+# The key is the one given with --key, else the first of the keys derived from the IMEIs and
+# uins of the handset (see key_candidates.py) which opens the database, else it is searched in
+# the keyspace: with libpassword_cracker.so when it is built (make), with the Python verifier
+# of sqlcipher_key.py otherwise. The decrypted database is carved from memory, without an
+# intermediate file; --decrypted also writes it to a file.
+#
+# Before the search, the settings of the database (page size, KDF, HMAC) are probed with the
+# known keys (--key, --probe-key, the derived keys) and checked against the file structure,
+# so that the keyspace is not searched with the wrong settings.
+#
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqliteret
+from key_candidates import load_candidates
+from keyspace import KeyspaceScheduler, run_workers, cpu_count, key_of, KEYSPACE_END, CHUNK_SECONDS
+from password_cracker import NativeCracker, LIB_PATH
+from sqlcipher_key import KeyVerifier, decrypt_database, page_decrypter, is_plain_database, probe, structure_check, PAGE_SIZE, KDF_ITER, KDF_ALGORITHM, KDF_ALGORITHMS, RESERVE
+
+
+def probe_settings(args):
+    '''Probes the settings of the database with the known and derived keys and sets them in args; returns the key
+    which opens the database, None if none does. Exits if the settings do not fit the file structure'''
+    keys = ([args.key] if args.key else []) + (args.probe_key or []) + load_candidates(args.imei_file, args.uin_file, args.prefs)
+    if keys:
+        print('Probing the settings of %s with %d keys...' % (args.db, len(keys)))
+        found = probe(args.db, keys)
+        if found:
+            print('Settings: %(version)s, page size %(page_size)d, kdf_iter %(kdf_iter)d, PBKDF2-HMAC-%(kdf_algorithm)s, %(reserve)d reserved bytes, HMAC %(hmac)s' % found)
+            args.page_size, args.kdf_iter = found['page_size'], found['kdf_iter']
+            args.kdf_algorithm, args.reserve = found['kdf_algorithm'], found['reserve']
+            return found['key']
+        print('None of these keys opens %s with the usual settings' % args.db)
+
+    #without a key, only the page size can be checked against the file
+    problems = structure_check(args.db, args.page_size)
+    if problems:
+        for problem in problems: print(problem)
+        print('Exiting program.')
+        exit(0)
+    return None
+
+
+def derived_key(args):
+    '''Returns the first key derived from the device identifiers which opens the database, None if there is none'''
+    keys = load_candidates(args.imei_file, args.uin_file, args.prefs)
+    if not keys: return None
+    print('Trying %d keys derived from the device identifiers...' % len(keys))
+    verifier = KeyVerifier(args.db, args.page_size, args.kdf_iter, args.reserve, args.kdf_algorithm)
+    with ThreadPoolExecutor(args.workers) as executor:
+        key = verifier.find(keys, executor)
+    if key is not None: return key
+    print('None of the derived keys opens %s' % args.db)
+    return None
+
+
+def search_key(args):
+    '''Searches the keyspace with the workers of the scheduler; returns the key found or None'''
+    scheduler = KeyspaceScheduler(args.start, args.end, args.workers, args.chunk_seconds)
+    status = open(args.status_file, 'a') if args.status_file else None
+    hits = []
+
+    if os.path.exists(LIB_PATH) and not args.python:
+        #native search: the worker threads share the page 1 read by the library
+        print('Searching keys %s to %s with %d workers (native)...' % (key_of(args.start), key_of(args.end), scheduler.workers))
+        cracker = NativeCracker(args.db, page_size=args.page_size, kdf_iter=args.kdf_iter, reserve=args.reserve, kdf_algorithm=args.kdf_algorithm)
+        found = threading.Event()
+        def search(start, end):
+            key, tried = cracker.search(start, end)
+            if key is not None: hits.append(key_of(key))
+            if cracker.stopped(): found.set()
+            return tried
+        try:
+            run_workers(scheduler, search, found, args.status_every, status)
+        finally:
+            cracker.close()
+    else:
+        #Python search: the keys of each range are derived in batches by a pool of threads, in parallel
+        #as hashlib.pbkdf2_hmac releases the GIL, then checked against page 1
+        print('Searching keys %s to %s with %d threads...' % (key_of(args.start), key_of(args.end), scheduler.workers))
+        verifier = KeyVerifier(args.db, args.page_size, args.kdf_iter, args.reserve, args.kdf_algorithm)
+        found = threading.Event()
+        with ThreadPoolExecutor(scheduler.workers) as executor:
+            def search(start, end):
+                key = verifier.find((key_of(n) for n in range(start, end + 1)), executor, stop=found)
+                if key is None: return end - start + 1
+                hits.append(key)
+                found.set()
+                return int(key, 16) - start + 1
+            run_workers(scheduler, search, found, args.status_every, status)
+
+    if status: status.close()
+    return hits[0] if hits else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recovers the deleted messages of an encrypted EnMicroMsg.db: searches its key, decrypts it in memory and carves the deleted rows.')
+    parser.add_argument('db', help='encrypted database (EnMicroMsg.db)')
+
+    search = parser.add_argument_group('key search')
+    search.add_argument('--key', help='key of the database, when it is known')
+    search.add_argument('--probe-key', action='append', metavar='KEY', help='a key which may open the database, used to detect its settings (may be repeated)')
+    search.add_argument('--no-probe', action='store_true', help='use the given settings as they are, without probing them')
+    search.add_argument('--imei-file', metavar='FILE', help='IMEIs of the handset, one per line')
+    search.add_argument('--uin-file', metavar='FILE', help='uins of the WeChat accounts, one per line')
+    search.add_argument('--prefs', metavar='PATH', help='shared_prefs directory of the WeChat data, or an XML file of it')
+    search.add_argument('-w', '--workers', type=int, default=cpu_count(), help='key search workers (default: number of cores)')
+    search.add_argument('--chunk-seconds', type=float, default=CHUNK_SECONDS, help='target duration of a range of keys, from which its size is tuned (default: %(default)s)')
+    search.add_argument('--start', type=lambda x: int(x, 16), default=0, help='first key to try, in hex (default: 0000000)')
+    search.add_argument('--end', type=lambda x: int(x, 16), default=KEYSPACE_END, help='last key to try, in hex (default: fffffff)')
+    search.add_argument('--status-every', type=float, default=10, metavar='SECONDS', help='interval of the JSON status lines of the search (default: 10, 0 for the last one only)')
+    search.add_argument('--status-file', metavar='FILE', help='file the JSON status lines are appended to (default: standard output)')
+    search.add_argument('--python', action='store_true', help='search with the Python verifier, in threads, even if libpassword_cracker.so is built')
+
+    decryption = parser.add_argument_group('decryption')
+    decryption.add_argument('--page-size', type=int, default=PAGE_SIZE, help='SQLCipher page size (default: %(default)s)')
+    decryption.add_argument('--kdf-iter', type=int, default=KDF_ITER, help='PBKDF2 iterations (default: %(default)s)')
+    decryption.add_argument('--reserve', type=int, default=RESERVE, help='reserved bytes at the end of each page: 16 for the IV, more with HMAC (default: %(default)s)')
+    decryption.add_argument('--kdf-algorithm', choices=KDF_ALGORITHMS, default=KDF_ALGORITHM, help='hash of PBKDF2-HMAC (default: %(default)s)')
+    decryption.add_argument('--decrypted', metavar='FILE', help='also write the decrypted database to FILE')
+    decryption.add_argument('--no-carve', action='store_true', help='stop after the decryption')
+
+    sqliteret.add_carving_arguments(parser.add_argument_group('carving'))
+    args = parser.parse_args()
+
+    if is_plain_database(args.db):
+        print('%s is not encrypted, carving it as it is' % args.db)
+        if not args.no_carve: sqliteret.carve(args, args.db)
+        return
+
+    start = time.time()
+    if args.no_probe:
+        key = args.key or derived_key(args) or search_key(args)
+    else:
+        #the derived keys are tried by the probe, with every usual setting
+        key = probe_settings(args) or args.key or search_key(args)
+    if key is None:
+        print('The key of %s has not been found.' % args.db)
+        return
+    print('Key: %s (%.1f s)' % (key, time.time() - start))
+
+    image = decrypt_database(args.db, key, args.page_size, args.kdf_iter, args.reserve, use_mmap = not args.no_mmap, kdf_algorithm = args.kdf_algorithm)
+    if image is None:
+        print('%s does not open %s with these settings.' % (key, args.db))
+        return
+    print('Decrypted %d pages' % (len(image) // args.page_size))
+    if args.decrypted:
+        with open(args.decrypted, 'wb') as f:
+            f.write(image)
+    if args.no_carve: return
+
+    #the WAL file and journal of the database, encrypted as it is, are found next to it rather than next to a temporary copy
+    if args.wal == '': args.wal = args.db + '-wal'
+    if args.journal == '': args.journal = args.db + '-journal'
+    decrypt = page_decrypter(args.db, key, args.page_size, args.kdf_iter, args.reserve, args.kdf_algorithm)
+
+    #the carver reads the schema and the live rows from an in-memory copy (Python 3.11 and later)
+    if hasattr(sqlite3.Connection, 'deserialize'):
+        sqliteret.carve(args, args.db, image, decrypt)
+        return
+    path = args.decrypted
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        with os.fdopen(fd, 'wb') as f: f.write(image)
+    try:
+        sqliteret.carve(args, path, decrypt = decrypt)
+    finally:
+        if not args.decrypted: os.remove(path)
+
+
+if __name__ == '__main__':
+    main()